@@ -8,14 +8,36 @@ Douyu Live Crawler + Autoplay Click + Quality Selector + tshark Capture
 """
 
 import os
+import json
+import csv
 import re
 import time
 import random
 import subprocess
+import signal
+import atexit
+import mmap
+import struct
+import ipaddress
 import traceback
+import threading
+import queue
+import tempfile
+import shutil
+import sys
+import ctypes
+import ctypes.util
+import select
+import socket
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from dataclasses import dataclass
-from typing import Dict, List, Tuple, Optional, Set
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, List, Tuple, Optional, Set, Union
+from urllib.parse import urlparse
+
+import urllib3
 
 # Selenium
 from selenium import webdriver
@@ -24,7 +46,6 @@ from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, WebDriverException
 
 
@@ -34,6 +55,20 @@ from selenium.common.exceptions import TimeoutException, WebDriverException
 LIVE_HOME = "https://www.douyu.com/"
 ROOM_RE = re.compile(r"^https?://www\.douyu\.com/\d+/?$")
 
+# 热浏览器模式下房间之间要清理的站点 origin
+SITE_ORIGINS = ("https://www.douyu.com",)
+
+# 采集台账里的平台名
+PLATFORM = "douyu"
+
+# 页面内的房间 URL 规范化（与 normalize_room_url 一致：去 query、去结尾 /）
+ROOM_NORMALIZE_JS = r"""
+(href) => {
+  const h = href.split('?')[0].replace(/\/+$/, '');
+  return /^https?:\/\/www\.douyu\.com\/\d+$/.test(h) ? h : null;
+}
+"""
+
 
 # ----------------------------
 # 运行配置
@@ -64,6 +99,114 @@ class RunConfig:
     driver_start_retries: int = 4
     driver_start_backoff: float = 1.2
 
+    # ✅ 并发采集：同时采集的直播间数（每个 worker 独立 Chrome + 独立 profile 副本 + 独立 pcap）
+    # 1 = 逐个采集（与原行为一致）
+    max_concurrent_sessions: int = 1
+
+    # 并发时 profile 副本存放目录（None = 系统临时目录）
+    profile_clone_root: Optional[str] = None
+
+    # ✅ 热浏览器：同一个 worker 内复用 Chrome，房间之间只重置状态（省掉冷启动 + 等 profile 锁）
+    reuse_browser: bool = False
+    # 复用多少个房间后强制重启一次浏览器（防止长期运行内存上涨）
+    browser_recycle_after: int = 20
+
+    # ✅ 登录态保险箱：设置后先从登录 profile 导出一次 cookie + localStorage 到这个 JSON，
+    # 之后每个浏览器都用一次性临时 profile 启动并注入登录态（不再争用 profile 锁，可任意并发）
+    login_vault_path: Optional[str] = None
+    # 保险箱超过多少小时重新导出
+    login_vault_max_age_hours: float = 24.0
+
+    # ✅ 房间发现后端："selenium" = 打开分类页滚动抓链接；"http" = 直接调平台列表接口（不启动浏览器），
+    # 接口失败或分类不支持时自动回退 selenium
+    discovery_backend: str = "selenium"
+    # 列表接口根地址（None = 平台官方地址；可指向本地回放服务器做测试）
+    discovery_api_base: Optional[str] = None
+
+    # ✅ 发现缓存：分类 / 房间列表落盘到这个 JSON，无限循环的下一轮直接复用（None = 不缓存）
+    discovery_cache_path: Optional[str] = None
+    categories_cache_ttl: float = 6 * 3600
+    rooms_cache_ttl: float = 600
+    discovery_cache_max_entries: int = 64
+
+    # ✅ 采集台账（SQLite）：记录每个房间的采集时间 / 画质 / pcap 路径（None = 不记录）
+    ledger_path: Optional[str] = None
+    ledger_window_hours: float = 12.0
+    # "skip" = 窗口内采过的房间直接跳过；"deprioritize" = 排到列表最后
+    ledger_policy: str = "skip"
+    # 开了台账时发现 rooms_per_category × ledger_overfetch 个房间，跳过采过的之后再截到 rooms_per_category
+    ledger_overfetch: int = 3
+    # 一轮没有可采的房间（都采过 / 都下播）时 main() 先等这么久再返回，免得外层循环空转
+    idle_backoff_seconds: float = 300.0
+
+    # ✅ 页面加载策略 + 播放器就绪的分阶段超时（秒）：有 video / readyState>=3 / currentTime 在走
+    page_load_strategy: str = "eager"
+    ready_video_timeout: float = 15.0
+    ready_buffer_timeout: float = 10.0
+    ready_play_timeout: float = 8.0
+
+    # ✅ 画质选择总时限（秒）：页面内状态机一次调用跑完，超时即按当前画质继续
+    quality_select_deadline: float = 10.0
+
+    # ✅ 选择器统计（JSON）：按历史成功率 / 耗时排序控件选择器（None = 只在进程内记忆）
+    selector_stats_path: Optional[str] = None
+    selector_stale_days: float = 14.0
+    selector_evict_failures: int = 3
+
+    # ✅ 播放健康监视：停留期间 health_stall_seconds 秒没前进就提前结束（health_abort=False 只记录采样、不中断）
+    health_abort: bool = True
+    health_stall_seconds: float = 12.0
+    health_sample_ms: int = 1000
+
+    # ✅ 开播预检：开浏览器前先用状态接口查一遍（线程池并发；查询失败的房间照常保留）
+    liveness_check: bool = True
+    liveness_workers: int = 8
+    liveness_api_base: Optional[str] = None     # None = 平台默认状态接口域名
+
+    # ✅ 抓包控制器：会话开始 / 结束时启停 tshark
+    capture_start_timeout: float = 10.0    # 等 tshark 写出文件头（网卡已打开）的上限
+    capture_stop_timeout: float = 5.0      # 发停止信号后等它自己收尾的上限，超时再 terminate / kill
+
+    # ✅ 抓包后端："tshark" = 每个会话单独起 tshark；"dumpcap" = 常驻 dumpcap，网卡只打开一次，会话边界只切换输出文件；
+    #    "afpacket" = Linux 进程内 AF_PACKET 环（不起子进程，可读内核丢包计数）
+    capture_backend: str = "tshark"
+    dumpcap_path: str = "dumpcap"
+
+    # ✅ 抓包过滤 / 截断（各后端通用）：BPF 表达式（tcpdump 语法）与每包最多保存的字节数（0 = 整包）
+    capture_filter: Optional[str] = None
+    capture_snaplen: int = 0
+    afpacket_ring_mb: int = 64             # capture_backend="afpacket" 时内核环形缓冲大小
+
+    # ✅ 只保留本会话 Chrome 进程树的流量（Linux：/proc 里的 socket inode → 五元组；其它系统忽略）
+    capture_process_only: bool = False
+    capture_process_poll: float = 0.5      # 扫描进程树 / socket 表的间隔（秒）
+
+    # ✅ 网络命名空间隔离（Linux，需要 root）：每个 worker 的 Chrome 跑在自己的 netns 里，经 veth 对 + NAT 出网；
+    #    抓包只听这个 worker 的 veth，并发会话的流量互不混
+    netns_isolation: bool = False
+    netns_pool_size: int = 0                  # 预先建好的 netns 个数（0 = 按并发数）
+    netns_subnet: str = "10.231.0.0/16"       # 每个 netns 占其中一个 /30
+    netns_uplink: Optional[str] = None        # NAT 出口网卡（None = network_iface）
+    netns_dns: Tuple[str, ...] = ("223.5.5.5", "119.29.29.29")
+    netns_name: Optional[str] = None          # 内部用：worker 分到的 netns（run_sessions_concurrently 填）
+    netns_driver_port: int = 9515             # netns 里 chromedriver 的端口（各 netns 端口空间独立，可以共用）
+
+    # ✅ 共享抓包按房间分流（capture_backend 为 dumpcap / afpacket 时）："devtools" = 每个包只写进连过这个远端 IP 的会话，
+    #    远端 IP 取自 DevTools Network 事件；归属已知的包当场写，还没人认领的包在内存里最多压
+    #    capture_demux_hold 秒 / capture_demux_hold_mb MB 等归属（None = 每个会话收整张网卡）
+    capture_demux: Optional[str] = None
+    capture_demux_hold: float = 20.0
+    capture_demux_hold_mb: int = 64
+
+    # ✅ 流标注：每个 pcap 旁边写 <pcap>.labels.json，远端 IP:端口 / SNI 域名 → 流类型
+    #    （直播流 / 媒体分片 / 弹幕 websocket / 广告 / 埋点…），取自 DevTools Network 事件，训练时不用再跑 DPI
+    flow_labels: bool = False
+
+    # ✅ 媒体时间线：每个媒体响应（直播流 / 分片）一行：URL 模式 / 字节数 / 请求·响应·结束时间 / 推算码率，
+    #    写 <pcap>.media.parquet（没装 pyarrow 则 .media.csv）；时间是和 pcap 同一个系统时钟的 epoch 秒，边收边写盘
+    media_timeline: bool = False
+    media_timeline_format: str = "parquet"
+
 
 # ----------------------------
 # profile 锁处理（复用登录态 + 频繁重启必备）
@@ -73,6 +216,93 @@ def _profile_lock_files(user_data_dir: str) -> List[str]:
     return [os.path.join(user_data_dir, n) for n in names]
 
 
+def _lock_owner(user_data_dir: str) -> Optional[Tuple[str, int]]:
+    """
+    Linux/macOS 上 SingletonLock 是指向 "<hostname>-<pid>" 的符号链接，读出持锁进程。
+    Windows 上不是符号链接，返回 None（只能靠轮询）。
+    """
+    if os.name != "posix":
+        return None
+    try:
+        target = os.readlink(os.path.join(user_data_dir, "SingletonLock"))
+    except OSError:
+        return None
+    host, _, pid = target.rpartition("-")
+    if not host or not pid.isdigit():
+        return None
+    return host, int(pid)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def reclaim_stale_profile_lock(user_data_dir: str) -> bool:
+    """
+    持锁的 Chrome 已经不在了（同一台机器上 PID 不存在）→ 立刻清锁，不用等超时。
+    返回锁文件是不是真的删掉了（删不掉时由调用方继续等 / 超时）。
+    """
+    owner = _lock_owner(user_data_dir)
+    if not owner:
+        return False
+    host, pid = owner
+    if host != socket.gethostname() or _pid_alive(pid):
+        return False
+    print(f"🧹 profile 锁的持有进程 {pid} 已退出，直接回收")
+    cleanup_profile_locks_if_needed(user_data_dir)
+    return all(not os.path.lexists(p) for p in _profile_lock_files(user_data_dir))
+
+
+class _InotifyWatcher:
+    """Linux inotify：user-data-dir 里有文件被删除/移走时唤醒（ctypes 直接调 libc，无额外依赖）。"""
+
+    IN_MOVED_FROM = 0x00000040
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+
+    def __init__(self, path: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        mask = self.IN_MOVED_FROM | self.IN_DELETE | self.IN_DELETE_SELF
+        if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, "inotify_add_watch 失败")
+        self.fd = fd
+
+    def wait(self, timeout: float) -> None:
+        r, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if r:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self) -> None:
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+def _open_lock_watcher(user_data_dir: str) -> Optional[_InotifyWatcher]:
+    if not sys.platform.startswith("linux") or not os.path.isdir(user_data_dir):
+        return None
+    try:
+        return _InotifyWatcher(user_data_dir)
+    except (OSError, AttributeError):
+        return None
+
+
 def get_user_data_dir_from_arg(user_data_arg: str) -> Optional[str]:
     if not user_data_arg:
         return None
@@ -83,13 +313,33 @@ def get_user_data_dir_from_arg(user_data_arg: str) -> Optional[str]:
 
 
 def wait_profile_released(user_data_dir: str, timeout: float = 12.0, poll: float = 0.25) -> bool:
+    """
+    等 Chrome 退出后释放 profile 锁。
+    Linux 用 inotify 等锁文件被删除（事件驱动，不空转）；其他平台按 poll 轮询。
+    持锁进程已经死掉的残留锁会立刻回收。
+    """
     end = time.time() + timeout
     lock_files = _profile_lock_files(user_data_dir)
-    while time.time() < end:
-        if all(not os.path.exists(p) for p in lock_files):
-            return True
-        time.sleep(poll)
-    return False
+    watcher = _open_lock_watcher(user_data_dir)
+    try:
+        while True:
+            # SingletonLock 是悬空符号链接，os.path.exists 会误判为“不存在”，要用 lexists
+            if all(not os.path.lexists(p) for p in lock_files):
+                return True
+            remaining = end - time.time()
+            if remaining <= 0:
+                return False
+            if reclaim_stale_profile_lock(user_data_dir):
+                continue
+
+            if watcher:
+                # 进程被强杀时不会删锁、也就没有事件：最多 1s 醒一次复查 PID
+                watcher.wait(min(remaining, 1.0))
+            else:
+                time.sleep(min(poll, remaining))
+    finally:
+        if watcher:
+            watcher.close()
 
 
 def cleanup_profile_locks_if_needed(user_data_dir: str) -> None:
@@ -99,12 +349,156 @@ def cleanup_profile_locks_if_needed(user_data_dir: str) -> None:
     """
     for p in _profile_lock_files(user_data_dir):
         try:
-            if os.path.exists(p):
+            if os.path.lexists(p):
                 os.remove(p)
         except Exception:
             pass
 
 
+# ----------------------------
+# 登录态保险箱：登录好的 profile 导出一次 cookie + localStorage，
+# 之后每个浏览器都用一次性临时 profile，启动后通过 DevTools 注入登录态
+# ----------------------------
+# Network.setCookies 接受的字段（getAllCookies 多出来的 size/session 等要去掉）
+_COOKIE_PARAM_KEYS = ("name", "value", "domain", "path", "secure", "httpOnly", "sameSite", "expires", "priority")
+
+
+def shared_profile_dir(cfg: RunConfig) -> Optional[str]:
+    """会被多个 Chrome 争用的 user-data-dir；保险箱模式下每个浏览器用自己的临时 profile，不存在争用。"""
+    if cfg.login_vault_path:
+        return None
+    return get_user_data_dir_from_arg(cfg.user_data_arg or "")
+
+
+def _cookie_for_sites(cookie: dict) -> bool:
+    """这个 cookie 会不会发给 SITE_ORIGINS 里的站点（domain 等于站点域名或是它的上级域）。"""
+    domain = (cookie.get("domain") or "").lstrip(".").lower()
+    if not domain:
+        return False
+    for origin in SITE_ORIGINS:
+        host = urlparse(origin).hostname or ""
+        if host == domain or host.endswith("." + domain):
+            return True
+    return False
+
+
+def export_login_vault(cfg: RunConfig) -> dict:
+    """用真正登录过的 profile 启动一次，导出本平台站点的 cookie + 各站点 origin 的 localStorage。"""
+    src_cfg = replace(cfg, login_vault_path=None)
+    driver = build_driver_with_retry(src_cfg)
+    try:
+        # getAllCookies 是整个 profile 的（所有网站），只留本平台的，别把无关的登录凭证落盘
+        cookies = [c for c in driver.execute_cdp_cmd("Network.getAllCookies", {}).get("cookies", [])
+                   if _cookie_for_sites(c)]
+
+        local_storage: Dict[str, Dict[str, str]] = {}
+        for origin in SITE_ORIGINS:
+            try:
+                driver.get(origin + "/")
+                local_storage[origin] = driver.execute_script("""
+                    const o = {};
+                    for (let i = 0; i < localStorage.length; i++) {
+                      const k = localStorage.key(i);
+                      o[k] = localStorage.getItem(k);
+                    }
+                    return o;
+                """) or {}
+            except Exception as e:
+                print(f"⚠️ 导出 localStorage 失败: {origin}，原因: {type(e).__name__}")
+    finally:
+        quit_driver(driver)
+        user_data_dir = shared_profile_dir(src_cfg)
+        if user_data_dir:
+            wait_profile_released(user_data_dir, timeout=12.0)
+
+    vault = {"exported_at": time.time(), "cookies": cookies, "local_storage": local_storage}
+
+    # 里面是登录凭证：只给当前用户读写
+    d = os.path.dirname(os.path.abspath(cfg.login_vault_path))
+    os.makedirs(d, exist_ok=True)
+    tmp = cfg.login_vault_path + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(vault, f, ensure_ascii=False)
+    os.chmod(tmp, 0o600)    # tmp 已存在时 os.open 不会改权限
+    os.replace(tmp, cfg.login_vault_path)
+
+    print(f"🔐 登录态已导出: {len(cookies)} 个 cookie，{len(local_storage)} 个站点 localStorage -> {cfg.login_vault_path}")
+    return vault
+
+
+def load_login_vault(path: str) -> Optional[dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def ensure_login_vault(cfg: RunConfig) -> None:
+    """保险箱不存在或超过 login_vault_max_age_hours 就重新导出（此时不能有别的 Chrome 占着登录 profile）。"""
+    if not cfg.login_vault_path:
+        return
+    vault = load_login_vault(cfg.login_vault_path)
+    if vault and time.time() - float(vault.get("exported_at", 0)) < cfg.login_vault_max_age_hours * 3600:
+        return
+    export_login_vault(cfg)
+
+
+def inject_login_vault(driver, vault: Optional[dict]) -> None:
+    if not vault:
+        print("⚠️ 登录态保险箱为空，临时 profile 将以未登录状态运行")
+        return
+
+    cookies = []
+    for c in vault.get("cookies", []):
+        p = {k: c[k] for k in _COOKIE_PARAM_KEYS if k in c}
+        if p.get("expires", -1) < 0:
+            p.pop("expires", None)  # 会话 cookie
+        cookies.append(p)
+    if cookies:
+        driver.execute_cdp_cmd("Network.setCookies", {"cookies": cookies})
+
+    # localStorage 只能在对应 origin 的页面里写：注册成“每个新文档先执行”的脚本
+    ls = vault.get("local_storage") or {}
+    if ls:
+        driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": """
+            (() => {
+              try {
+                const data = %s[location.origin];
+                if (!data) return;
+                for (const [k, v] of Object.entries(data)) {
+                  if (localStorage.getItem(k) === null) localStorage.setItem(k, v);
+                }
+              } catch (e) {}
+            })();
+        """ % json.dumps(ls, ensure_ascii=False)})
+
+
+def quit_driver(driver) -> None:
+    """driver.quit()；如果是保险箱模式的临时 profile，顺便删掉。"""
+    ephemeral_dir = getattr(driver, "ephemeral_profile_dir", None)
+    try:
+        driver.quit()
+    except Exception:
+        pass
+    # netns 模式：chromedriver 是我们自己起的，Remote.quit() 不会结束它
+    proc = getattr(driver, "netns_chromedriver", None)
+    if proc is not None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except Exception:
+            proc.kill()
+    if ephemeral_dir:
+        # Windows 上 Chrome 退出后文件句柄可能晚一点才释放
+        for _ in range(3):
+            shutil.rmtree(ephemeral_dir, ignore_errors=True)
+            if not os.path.exists(ephemeral_dir):
+                break
+            time.sleep(0.5)
+
+
 # ----------------------------
 # Selenium：创建 driver
 # ----------------------------
@@ -123,24 +517,49 @@ def build_driver(cfg: RunConfig) -> webdriver.Chrome:
     options.add_argument("--disk-cache-size=0")
     options.add_argument("--dns-prefetch-disable")
 
-    if cfg.user_data_arg:
-        arg = cfg.user_data_arg.strip()
-        if not arg.startswith("--"):
-            arg = "--" + arg
-        options.add_argument(arg)
+    # ✅ 复用登录态：保险箱模式用一次性临时 profile（启动后注入登录态），否则直接用登录 profile
+    ephemeral_dir = None
+    if cfg.login_vault_path:
+        ephemeral_dir = tempfile.mkdtemp(prefix="lvcap_eph_", dir=cfg.profile_clone_root)
+        options.add_argument(f"--user-data-dir={ephemeral_dir}")
+    else:
+        if cfg.user_data_arg:
+            arg = cfg.user_data_arg.strip()
+            if not arg.startswith("--"):
+                arg = "--" + arg
+            options.add_argument(arg)
+
+        if cfg.profile_directory:
+            options.add_argument(f"--profile-directory={cfg.profile_directory}")
+
+    # 抓包分流 / 流标注 / 媒体时间线：从 performance 日志里读 Network 事件
+    if devtools_events_wanted(cfg):
+        options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+        options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": True, "enablePage": False})
+
+    # eager：DOMContentLoaded 就返回，不等广告/统计脚本；播放器是否就绪由 wait_player_ready 判断
+    options.page_load_strategy = cfg.page_load_strategy
 
-    if cfg.profile_directory:
-        options.add_argument(f"--profile-directory={cfg.profile_directory}")
-
-    service = Service(cfg.chromedriver_path)
-    driver = webdriver.Chrome(service=service, options=options)
+    try:
+        if cfg.netns_name:
+            driver = build_driver_in_netns(cfg, options)
+        else:
+            driver = webdriver.Chrome(service=Service(cfg.chromedriver_path), options=options)
+    except Exception:
+        if ephemeral_dir:
+            shutil.rmtree(ephemeral_dir, ignore_errors=True)
+        raise
+    driver.ephemeral_profile_dir = ephemeral_dir
     driver.set_page_load_timeout(60)
+
+    if ephemeral_dir:
+        inject_login_vault(driver, load_login_vault(cfg.login_vault_path))
     return driver
 
 
 def build_driver_with_retry(cfg: RunConfig) -> webdriver.Chrome:
     last_err = None
-    user_data_dir = get_user_data_dir_from_arg(cfg.user_data_arg or "")
+    user_data_dir = shared_profile_dir(cfg)
 
     for i in range(cfg.driver_start_retries):
         try:
@@ -167,17 +586,737 @@ def build_driver_with_retry(cfg: RunConfig) -> webdriver.Chrome:
 
 
 # ----------------------------
-# tshark 抓包
+# 网络命名空间池（Linux）：每个 worker 一个 netns + veth 对，chromedriver 在 netns 里启动，
+# 本进程经 veth 用 webdriver.Remote 连过去；抓包听宿主侧的 veth
+# ----------------------------
+class NetnsSlot:
+    def __init__(self, index: int, prefix: str, base: ipaddress.IPv4Address):
+        self.name = f"{prefix}{index}"
+        self.host_if = f"{prefix}h{index}"
+        self.ns_if = f"{prefix}n{index}"
+        self.cidr = f"{base}/30"
+        self.host_ip = str(base + 1)
+        self.ns_ip = str(base + 2)
+
+
+def _run_ip(cmd: List[str], check: bool = True) -> bool:
+    try:
+        r = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    except FileNotFoundError:
+        if check:
+            raise RuntimeError(f"找不到 {cmd[0]}（netns 模式需要 iproute2 / iptables）")
+        return False
+    if check and r.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)} 失败: {r.stderr.strip()}")
+    return r.returncode == 0
+
+
+class NetnsPool:
+    """
+    预先建好 N 个 netns（建一次、整个进程复用，多轮 main() 不重复建）；进程退出时统一拆掉。
+    每个 netns：veth 对（宿主侧 /30 第一个地址，netns 侧第二个）+ 默认路由 + 宿主 MASQUERADE 出网 + 独立 resolv.conf。
+    """
+
+    PREFIX = "lvcap"
+
+    def __init__(self, cfg: RunConfig):
+        self.subnet = ipaddress.ip_network(cfg.netns_subnet)
+        self.uplink = cfg.netns_uplink or cfg.network_iface
+        self.dns = cfg.netns_dns
+        self.slots: List[NetnsSlot] = []
+        self._lock = threading.Lock()
+
+    def ensure(self, n: int) -> List[NetnsSlot]:
+        with self._lock:
+            while len(self.slots) < n:
+                i = len(self.slots)
+                slot = NetnsSlot(i, self.PREFIX, self.subnet.network_address + 4 * i)
+                if ipaddress.ip_address(slot.ns_ip) not in self.subnet:
+                    raise RuntimeError(f"netns_subnet {self.subnet} 放不下 {n} 个 /30")
+                self._create(slot)
+                self.slots.append(slot)
+            return self.slots[:n]
+
+    def _nat_rules(self, slot: NetnsSlot) -> List[List[str]]:
+        return [
+            ["nat", "POSTROUTING", "-s", slot.cidr, "-o", self.uplink, "-j", "MASQUERADE"],
+            ["filter", "FORWARD", "-i", slot.host_if, "-j", "ACCEPT"],
+            ["filter", "FORWARD", "-o", slot.host_if, "-j", "ACCEPT"],
+        ]
+
+    def _create(self, slot: NetnsSlot) -> None:
+        t0 = time.time()
+        self._destroy(slot)    # 上次异常退出留下的同名残留
+        ns = ["ip", "netns", "exec", slot.name]
+        _run_ip(["ip", "netns", "add", slot.name])
+        _run_ip(["ip", "link", "add", slot.host_if, "type", "veth", "peer", "name", slot.ns_if])
+        _run_ip(["ip", "link", "set", slot.ns_if, "netns", slot.name])
+        _run_ip(["ip", "addr", "add", f"{slot.host_ip}/30", "dev", slot.host_if])
+        _run_ip(["ip", "link", "set", slot.host_if, "up"])
+        _run_ip(ns + ["ip", "addr", "add", f"{slot.ns_ip}/30", "dev", slot.ns_if])
+        _run_ip(ns + ["ip", "link", "set", slot.ns_if, "up"])
+        _run_ip(ns + ["ip", "link", "set", "lo", "up"])
+        _run_ip(ns + ["ip", "route", "add", "default", "via", slot.host_ip])
+        _run_ip(["sysctl", "-q", "-w", "net.ipv4.ip_forward=1"])
+        for table, chain, *rule in self._nat_rules(slot):
+            if not _run_ip(["iptables", "-t", table, "-C", chain] + rule, check=False):
+                _run_ip(["iptables", "-t", table, "-A", chain] + rule)
+        # ip netns exec 会把 /etc/netns/<name>/resolv.conf 绑定到 /etc/resolv.conf
+        os.makedirs(f"/etc/netns/{slot.name}", exist_ok=True)
+        with open(f"/etc/netns/{slot.name}/resolv.conf", "w") as f:
+            f.write("".join(f"nameserver {d}\n" for d in self.dns))
+        print(f"🧱 netns {slot.name} 就绪: {slot.host_if}({slot.host_ip}) ⇄ {slot.ns_if}({slot.ns_ip})，"
+              f"用时 {time.time() - t0:.2f}s")
+
+    def _destroy(self, slot: NetnsSlot) -> None:
+        for table, chain, *rule in self._nat_rules(slot):
+            for _ in range(8):    # 同一条规则可能被重复加过
+                if not _run_ip(["iptables", "-t", table, "-D", chain] + rule, check=False):
+                    break
+        _run_ip(["ip", "netns", "del", slot.name], check=False)   # netns 侧 veth 随之删除，对端一起消失
+        _run_ip(["ip", "link", "del", slot.host_if], check=False)
+        shutil.rmtree(f"/etc/netns/{slot.name}", ignore_errors=True)
+
+    def slot(self, name: str) -> Optional[NetnsSlot]:
+        return next((s for s in self.slots if s.name == name), None)
+
+    def teardown(self) -> None:
+        with self._lock:
+            for slot in self.slots:
+                self._destroy(slot)
+            self.slots = []
+
+
+_NETNS_POOL: Optional[NetnsPool] = None
+_NETNS_POOL_LOCK = threading.Lock()
+
+
+def netns_pool(cfg: RunConfig) -> NetnsPool:
+    global _NETNS_POOL
+    with _NETNS_POOL_LOCK:
+        if _NETNS_POOL is None:
+            if not sys.platform.startswith("linux") or os.geteuid() != 0:
+                raise RuntimeError("netns_isolation 需要 Linux + root（ip netns / iptables）")
+            _NETNS_POOL = NetnsPool(cfg)
+            atexit.register(_NETNS_POOL.teardown)
+        return _NETNS_POOL
+
+
+def netns_capture_filter(cfg: RunConfig, slot: NetnsSlot) -> str:
+    """worker 的抓包过滤：宿主 ↔ netns 里 chromedriver 的 WebDriver 请求也走这条 veth，排除掉。"""
+    own = f"not (host {slot.ns_ip} and tcp port {cfg.netns_driver_port})"
+    return f"({cfg.capture_filter}) and {own}" if cfg.capture_filter else own
+
+
+def build_driver_in_netns(cfg: RunConfig, options: Options):
+    """在 worker 的 netns 里起 chromedriver（只接受宿主侧 veth 地址的连接），本进程用 webdriver.Remote 连过去。"""
+    slot = netns_pool(cfg).slot(cfg.netns_name)
+    if slot is None:
+        raise RuntimeError(f"netns {cfg.netns_name} 不在池里")
+    port = cfg.netns_driver_port
+    proc = subprocess.Popen(
+        ["ip", "netns", "exec", slot.name, cfg.chromedriver_path, f"--port={port}", f"--allowed-ips={slot.host_ip}"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.time() + 15
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"netns 里的 chromedriver 启动即退出(code={proc.returncode})")
+            try:
+                socket.create_connection((slot.ns_ip, port), timeout=0.5).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise RuntimeError(f"netns 里的 chromedriver 15s 内没有监听 {slot.ns_ip}:{port}")
+                time.sleep(0.1)
+        driver = webdriver.Remote(command_executor=f"http://{slot.ns_ip}:{port}", options=options)
+    except Exception:
+        proc.terminate()
+        raise
+    driver.netns_chromedriver = proc
+    return driver
+
+
+# ----------------------------
+# 热浏览器：跨房间复用同一个 Chrome，房间之间重置到干净状态
+# ----------------------------
+def _driver_alive(driver) -> bool:
+    try:
+        _ = driver.window_handles
+        return True
+    except Exception:
+        return False
+
+
+def reset_driver_state(driver, origins=SITE_ORIGINS) -> None:
+    """
+    房间之间的清场：只留一个标签页 → about:blank → 清 HTTP 缓存 / Cache Storage / service worker。
+    ⚠️ 不清 cookie / localStorage（登录态要保留）。
+    """
+    handles = driver.window_handles
+    for h in handles[1:]:
+        driver.switch_to.window(h)
+        driver.close()
+    driver.switch_to.window(handles[0])
+    driver.get("about:blank")
+
+    driver.execute_cdp_cmd("Network.clearBrowserCache", {})
+    for origin in origins:
+        driver.execute_cdp_cmd("Storage.clearDataForOrigin", {
+            "origin": origin,
+            "storageTypes": "service_workers,cache_storage",
+        })
+    try:
+        driver.execute_cdp_cmd("ServiceWorker.enable", {})
+        driver.execute_cdp_cmd("ServiceWorker.stopAllWorkers", {})
+        driver.execute_cdp_cmd("ServiceWorker.disable", {})
+    except Exception:
+        pass
+
+
+class WarmDriverPool:
+    """
+    每个 worker 一个：acquire() 拿到可用的 driver（没有/已失效/用满次数才冷启动），
+    release() 把浏览器重置到干净状态留给下一个房间；重置失败就直接关掉，下次重新冷启动。
+    """
+
+    def __init__(self, cfg: RunConfig):
+        self.cfg = cfg
+        self.driver = None
+        self.uses = 0
+
+    def acquire(self):
+        if self.driver is not None:
+            if self.uses >= self.cfg.browser_recycle_after or not _driver_alive(self.driver):
+                self.close()
+
+        if self.driver is None:
+            self.driver = build_driver_with_retry(self.cfg)
+            self.uses = 0
+
+        self.uses += 1
+        return self.driver
+
+    def release(self) -> None:
+        if self.driver is None:
+            return
+        try:
+            reset_driver_state(self.driver)
+        except Exception as e:
+            print(f"⚠️ 浏览器重置失败，关闭后下次重新启动: {type(e).__name__}")
+            self.close()
+
+    def close(self) -> None:
+        if self.driver is None:
+            return
+        quit_driver(self.driver)
+        self.driver = None
+
+        user_data_dir = shared_profile_dir(self.cfg)
+        if user_data_dir:
+            wait_profile_released(user_data_dir, timeout=12.0)
+
+
+LIVENESS_API_BASE = "https://www.douyu.com"
+
+
+def check_room_live(room_url: str, base: Optional[str] = None) -> Optional[bool]:
+    """betard/<rid>：room.show_status 1=开播，2=下播；videoLoop=1 是录像轮播，也算没在播。None = 判断不了"""
+    rid = canonical_room_id(room_url)
+    if not rid.isdigit():
+        # topic 活动页：真实房号在 ?rid= 里
+        m = re.search(r"[?&]rid=(\d+)", room_url or "")
+        if not m:
+            return None
+        rid = m.group(1)
+    base = (base or LIVENESS_API_BASE).rstrip("/")
+    data = http_get_json(f"{base}/betard/{rid}")
+    room = data.get("room") or {}
+    if "show_status" not in room:
+        return None
+    return int(room.get("show_status") or 0) == 1 and int(room.get("videoLoop") or 0) != 1
+
+
+# ----------------------------
+# 开播预检：开浏览器 / tshark 之前，线程池并发查一遍每个房间的状态接口，下播 / 轮播的直接剔掉
+# ----------------------------
+def filter_live_rooms(cfg: RunConfig, rooms: List[str]) -> List[str]:
+    """
+    只剔除接口明确说“没在播”的房间；查询失败、房号认不出（返回 None / 抛异常）一律保留，交给浏览器会话判断。
+    """
+    if not cfg.liveness_check or not rooms:
+        return rooms
+    t0 = time.time()
+    workers = max(1, min(cfg.liveness_workers, len(rooms)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="liveness") as pool:
+        futures = [pool.submit(check_room_live, r, cfg.liveness_api_base) for r in rooms]
+
+    live: List[str] = []
+    dead: List[str] = []
+    for room, fut in zip(rooms, futures):
+        try:
+            ok = fut.result()
+        except Exception as e:
+            print(f"⚠️ 开播预检失败，保留 {room}: {e}")
+            ok = None
+        (dead if ok is False else live).append(room)
+
+    print(f"🩺 开播预检: 保留 {len(live)} 间，剔除 {len(dead)} 间，用时 {time.time() - t0:.1f}s")
+    for r in dead:
+        print("   ✗", r)
+    return live
+
+
+# ----------------------------
+# 播放器就绪检测：eager 加载后按阶段等 <video>（有元素 → readyState>=3 → currentTime 在走）
+# ----------------------------
+PLAYER_STAGES = ("video", "buffer", "playing")
+
+PLAYER_READY_JS = r"""
+const stage = arguments[0], timeoutMs = arguments[1], done = arguments[arguments.length - 1];
+const t0 = performance.now();
+
+// 主文档 + 同源 iframe 里的所有 video，取面积最大的那个（跨域 iframe 读不到，跳过）
+function collect(doc, out) {
+  for (const v of doc.querySelectorAll('video')) out.push(v);
+  for (const f of doc.querySelectorAll('iframe')) {
+    try { if (f.contentDocument) collect(f.contentDocument, out); } catch (e) {}
+  }
+  return out;
+}
+function pick() {
+  let best = null, bestArea = -1;
+  for (const v of collect(document, [])) {
+    const r = v.getBoundingClientRect();
+    const a = r.width * r.height;
+    if (a > bestArea) { best = v; bestArea = a; }
+  }
+  return best;
+}
+function info(v) {
+  return v ? {readyState: v.readyState, currentTime: v.currentTime, paused: v.paused} : null;
+}
+
+let base = null, baseVideo = null;
+function check(v) {
+  if (stage === 'video') return !!v;
+  if (!v) return false;
+  if (stage === 'buffer') return v.readyState >= 3;
+  // playing：同一个 video 的 currentTime 比第一次采样前进了 0.3s 以上
+  if (v !== baseVideo) { baseVideo = v; base = v.currentTime; return false; }
+  return !v.paused && v.currentTime - base >= 0.3;
+}
+
+(function tick() {
+  const v = pick();
+  const ms = performance.now() - t0;
+  if (check(v)) return done({ok: true, ms: ms, info: info(v)});
+  if (ms >= timeoutMs) return done({ok: false, ms: ms, info: info(v)});
+  setTimeout(tick, 100);
+})();
+"""
+
+
+def wait_player_ready(driver, cfg: RunConfig, stages: Tuple[str, ...] = PLAYER_STAGES) -> dict:
+    """
+    每个阶段单独超时；某阶段超时就停在那里返回 ok=False（调用方照常往下走，只是不再盲等）。
+    返回 {"ok", "stage": 最后通过的阶段, "elapsed": {阶段: 秒}}。
+    """
+    timeouts = {
+        "video": cfg.ready_video_timeout,
+        "buffer": cfg.ready_buffer_timeout,
+        "playing": cfg.ready_play_timeout,
+    }
+    res = {"ok": False, "stage": None, "elapsed": {}}
+    for stage in stages:
+        t = timeouts[stage]
+        driver.set_script_timeout(t + 5)
+        r = driver.execute_async_script(PLAYER_READY_JS, stage, int(t * 1000)) or {}
+        res["elapsed"][stage] = round(r.get("ms", 0) / 1000.0, 2)
+        if not r.get("ok"):
+            print(f"⚠️ 播放器未就绪：{stage} 阶段超时 {t:g}s，状态 {r.get('info')}")
+            return res
+        res["stage"] = stage
+
+    res["ok"] = True
+    print("⏱️ 播放器就绪: " + " / ".join(f"{k} {v:.1f}s" for k, v in res["elapsed"].items()))
+    return res
+
+
+# ----------------------------
+# 播放健康监视：页面内定时采样 currentTime / buffered / getVideoPlaybackQuality / videoHeight，
+# 停留期间长时间不前进就提前结束会话（释放名额），并记录原因码
+# ----------------------------
+PLAYBACK_MONITOR_JS = r"""
+const sampleMs = arguments[0];
+if (window.__lvHealth) return true;
+
+const H = window.__lvHealth = {
+  samples: 0, last: null, lastCt: null, lastFrames: null, lastAdvanceAt: Date.now(), timer: null,
+};
+
+function collect(doc, out) {
+  for (const v of doc.querySelectorAll('video')) out.push(v);
+  for (const f of doc.querySelectorAll('iframe')) {
+    try { if (f.contentDocument) collect(f.contentDocument, out); } catch (e) {}
+  }
+  return out;
+}
+function pick() {
+  let best = null, bestArea = -1;
+  for (const v of collect(document, [])) {
+    const r = v.getBoundingClientRect();
+    const a = r.width * r.height;
+    if (a > bestArea) { best = v; bestArea = a; }
+  }
+  return best;
+}
+
+function sample() {
+  const now = Date.now();
+  const v = pick();
+  H.samples++;
+  if (!v) { H.last = {video: false}; return; }
+
+  let ahead = 0;
+  try {
+    for (let i = 0; i < v.buffered.length; i++) {
+      if (v.buffered.start(i) <= v.currentTime && v.currentTime <= v.buffered.end(i)) {
+        ahead = v.buffered.end(i) - v.currentTime;
+      }
+    }
+  } catch (e) {}
+  let q = null;
+  try { q = v.getVideoPlaybackQuality ? v.getVideoPlaybackQuality() : null; } catch (e) {}
+  const frames = q ? q.totalVideoFrames : null;
+
+  // 前进 = currentTime 在走，或解码帧数在涨
+  const advanced = (H.lastCt !== null && v.currentTime > H.lastCt + 0.05)
+                || (frames !== null && H.lastFrames !== null && frames > H.lastFrames);
+  if (advanced) H.lastAdvanceAt = now;
+  H.lastCt = v.currentTime;
+  H.lastFrames = frames;
+
+  H.last = {
+    video: true,
+    currentTime: v.currentTime,
+    bufferedAhead: Math.round(ahead * 100) / 100,
+    videoWidth: v.videoWidth,
+    videoHeight: v.videoHeight,
+    totalFrames: frames,
+    droppedFrames: q ? q.droppedVideoFrames : null,
+    paused: v.paused,
+    ended: v.ended,
+    readyState: v.readyState,
+    error: v.error ? v.error.code : null,
+  };
+}
+
+// 原因码：media_error / ended 立即判定；其余要连续 stallMs 没前进：no_video / paused / no_picture / stalled
+H.verdict = function (stallMs) {
+  const s = H.last || {video: false};
+  const idle = Date.now() - H.lastAdvanceAt;
+  let reason = null;
+  if (s.error) reason = 'media_error';
+  else if (s.ended) reason = 'ended';
+  else if (idle >= stallMs) {
+    reason = !s.video ? 'no_video' : s.paused ? 'paused' : (s.videoHeight === 0 ? 'no_picture' : 'stalled');
+  }
+  return Object.assign({}, s, {idleMs: idle, samples: H.samples, reason: reason});
+};
+
+sample();
+H.timer = setInterval(sample, sampleMs);
+return true;
+"""
+
+# 顺带带回 autoplay 遮罩监听的结果，停留期间还是每 1.5s 一次 WebDriver 调用
+PLAYBACK_VERDICT_JS = """
+if (!window.__lvHealth) return null;
+const v = window.__lvHealth.verdict(arguments[0]);
+v.autoplayOverlay = !!(window.__lvAutoplay && window.__lvAutoplay.present);
+return v;
+"""
+
+
+def dwell_with_health_monitor(driver, cfg: RunConfig,
+                              on_overlay: Optional[Callable[[], bool]] = None) -> Tuple[Optional[str], dict]:
+    """
+    停留 dwell_seconds；页面内每 health_sample_ms 采样，这里每 1.5s 读一次结论（一次 WebDriver 调用）。
+    结论里报告 autoplay 遮罩还在时先调 on_overlay（真实鼠标点击），点到了这一轮就不判异常。
+    返回 (原因码或 None, 最后一次采样)。原因码：media_error / ended / no_video / paused / no_picture / stalled。
+    """
+    try:
+        driver.execute_script(PLAYBACK_MONITOR_JS, cfg.health_sample_ms)
+    except Exception as e:
+        print(f"⚠️ 播放监视安装失败，按固定时长停留: {e}")
+
+    stall_ms = int(cfg.health_stall_seconds * 1000)
+    end_t = time.time() + cfg.dwell_seconds
+    last: dict = {}
+    while time.time() < end_t:
+        time.sleep(min(1.5, max(0.0, end_t - time.time())))
+        try:
+            last = driver.execute_script(PLAYBACK_VERDICT_JS, stall_ms) or last
+        except Exception:
+            continue
+        if on_overlay is not None and last.get("autoplayOverlay") and on_overlay():
+            continue
+        reason = last.get("reason")
+        if reason and cfg.health_abort:
+            print(f"⛔ 播放异常，提前结束: {reason}（{last.get('idleMs', 0) / 1000:.0f}s 未前进）")
+            return reason, last
+    return None, last
+
+
+# ----------------------------
+# tshark 抓包：会话事件驱动的抓包控制器（开始 / 停止由会话决定，不再靠 -a duration 猜时长）
 # ----------------------------
-def start_tshark_capture(cfg: RunConfig, filepath: str, duration: int) -> subprocess.Popen:
-    tshark_cmd = [
-        "tshark",
-        "-q",
-        "-a", f"duration:{duration}",
-        "-w", filepath,
-        "-i", cfg.network_iface,
-    ]
-    return subprocess.Popen(tshark_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+CAPTURE_GUARD_SECONDS = 300     # 只防进程失控的兜底上限；正常由控制器在停留结束时停掉
+
+
+def _iso_ts(t: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(t).astimezone().isoformat(timespec="milliseconds") if t else None
+
+
+def pcap_file_complete(path: str) -> Tuple[bool, int]:
+    """
+    顺着 pcap / pcapng 的记录头走一遍：最后一条记录完整 = 已经完整落盘（进程被硬杀时尾部会截断）。
+    返回 (是否完整, 包数)。
+    """
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            magic = f.read(4)
+            packets = 0
+            if magic == b"\x0a\x0d\x0d\x0a":
+                # pcapng：按块总长度跳，块尾会重复一遍长度
+                pos, order = 0, "little"
+                while pos < size:
+                    if pos + 12 > size:
+                        return False, packets
+                    f.seek(pos)
+                    head = f.read(12)
+                    if head[:4] == b"\x0a\x0d\x0d\x0a":
+                        order = "little" if head[8:12] == b"\x4d\x3c\x2b\x1a" else "big"
+                    btype = int.from_bytes(head[:4], order)
+                    blen = int.from_bytes(head[4:8], order)
+                    if blen < 12 or blen % 4 or pos + blen > size:
+                        return False, packets
+                    f.seek(pos + blen - 4)
+                    if int.from_bytes(f.read(4), order) != blen:
+                        return False, packets
+                    if btype in (3, 6):     # Simple / Enhanced Packet Block
+                        packets += 1
+                    pos += blen
+                return True, packets
+
+            if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+                order = "little"
+            elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+                order = "big"
+            else:
+                return False, 0
+            # 经典 pcap：24 字节文件头 + (16 字节记录头 + incl_len) * N
+            pos = 24
+            while pos < size:
+                if pos + 16 > size:
+                    return False, packets
+                f.seek(pos + 8)
+                pos += 16 + int.from_bytes(f.read(4), order)
+                if pos > size:
+                    return False, packets
+                packets += 1
+            return pos == size, packets
+    except OSError:
+        return False, 0
+
+
+class CaptureController:
+    """
+    一个会话一个控制器：start() 在浏览器就绪、打开直播间之前调用，等 tshark 写出文件头才返回；
+    stop() 在停留结束时调用，发干净的停止信号（POSIX SIGINT / Windows CTRL_BREAK）让 tshark 自己刷盘退出，
+    再检查文件是否完整。开始 / 停止的精确时间写进 meta。
+    capture_backend="dumpcap" 时不起进程，只在常驻 dumpcap 上开 / 关这个会话的 sink。
+    """
+
+    def __init__(self, cfg: RunConfig, filepath: str):
+        self.cfg = cfg
+        self.filepath = filepath
+        self.proc: Optional[subprocess.Popen] = None
+        self.started_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
+        self.stop_method: Optional[str] = None
+        self.complete: Optional[bool] = None
+        self.packets = 0
+        self.sink: Optional[CaptureSink] = None
+        self.tracker: Optional[ProcessFlowTracker] = None
+        self.remotes: Optional[DevtoolsRemoteTracker] = None
+        self.labels: Optional[FlowLabeler] = None
+        self.timeline: Optional[MediaTimelineRecorder] = None
+        self.devtools: Optional[DevtoolsNetworkLog] = None
+        self.filtered: Optional[Tuple[int, int]] = None
+
+    def start(self, driver=None) -> None:
+        if self.cfg.capture_process_only and driver is not None:
+            self._start_tracker(driver)
+
+        if self.cfg.capture_backend in ("dumpcap", "afpacket"):
+            # 常驻抓包：只开一个输出文件，网卡早就开着，没有启动延迟
+            self.sink = capture_daemon(self.cfg).open_sink(self.filepath)
+            self.started_at = self.sink.started_at
+            self._start_devtools(driver)
+            return
+        if self.cfg.capture_demux:
+            print("⚠️ capture_demux 需要 capture_backend=\"dumpcap\" / \"afpacket\"，本次收整张网卡")
+
+        guard = self.cfg.dwell_seconds + self.cfg.tshark_extra_seconds + CAPTURE_GUARD_SECONDS
+        tshark_cmd = [
+            "tshark",
+            "-q",
+            "-a", f"duration:{guard}",
+            "-w", self.filepath,
+            "-i", self.cfg.network_iface,
+        ]
+        if self.cfg.capture_filter:
+            tshark_cmd += ["-f", self.cfg.capture_filter]
+        if self.cfg.capture_snaplen:
+            tshark_cmd += ["-s", str(self.cfg.capture_snaplen)]
+        kwargs = {}
+        if os.name == "nt":
+            # 独立进程组才能单独收 CTRL_BREAK，不会连带本进程
+            kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        self.proc = subprocess.Popen(tshark_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **kwargs)
+
+        # dumpcap 打开网卡后才写文件头：文件头出现，抓包窗口才算真正开始
+        deadline = time.time() + self.cfg.capture_start_timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"tshark 启动即退出(code={self.proc.returncode})，检查网卡名 / 抓包权限")
+            try:
+                if os.path.getsize(self.filepath) > 0:
+                    break
+            except OSError:
+                pass
+            time.sleep(0.05)
+        else:
+            print(f"⚠️ {self.cfg.capture_start_timeout:.0f}s 内没等到抓包文件头，继续（开始时间可能偏早）")
+        self.started_at = time.time()
+        self._start_devtools(driver)
+
+    def _start_devtools(self, driver) -> None:
+        """分流 IP 收集 / 流标注 / 媒体时间线共用一个 DevTools 日志读者；都没开就不读。"""
+        if driver is None:
+            return
+        listeners = []
+        if self.sink is not None and self.sink.ips is not None:
+            self.remotes = DevtoolsRemoteTracker(self.sink)
+            listeners.append(self.remotes.on_event)
+        if self.cfg.flow_labels:
+            self.labels = FlowLabeler()
+            listeners.append(self.labels.on_event)
+        if self.cfg.media_timeline:
+            self.timeline = MediaTimelineRecorder(
+                TimelineWriter(self.filepath, self.cfg.media_timeline_format), self.started_at)
+            listeners.append(self.timeline.on_event)
+        if listeners:
+            self.devtools = DevtoolsNetworkLog(driver, listeners)
+            self.devtools.start()
+
+    def write_sidecars(self, pcap_path: str) -> None:
+        """pcap 定稿（改名）之后调用：流标注写 <pcap>.labels.json，媒体时间线跟着改名。"""
+        if self.labels is not None:
+            write_flow_labels(pcap_path, self.labels.summary())
+        if self.timeline is not None:
+            self.timeline.writer.move(pcap_path)
+
+    def _start_tracker(self, driver) -> None:
+        if not sys.platform.startswith("linux"):
+            print("⚠️ capture_process_only 只支持 Linux，本次保留整张网卡的流量")
+            return
+        try:
+            # chromedriver；Chrome 和它的子进程都在这棵树下（netns 模式下是自己起的那个）
+            root_pid = (getattr(driver, "netns_chromedriver", None) or driver.service.process).pid
+        except AttributeError:
+            print("⚠️ 拿不到 chromedriver 进程号，本次保留整张网卡的流量")
+            return
+        self.tracker = ProcessFlowTracker(root_pid, self.cfg.capture_process_poll)
+        self.tracker.start()
+
+    def stop(self) -> None:
+        if (self.proc is None and self.sink is None) or self.stopped_at is not None:
+            return
+        self.stopped_at = time.time()    # 窗口在发停止信号这一刻结束
+        if self.tracker is not None:
+            self.tracker.stop()
+        if self.devtools is not None:
+            self.devtools.stop()
+        if self.timeline is not None:
+            self.timeline.close()
+        proc = self.proc
+        if self.sink is not None:
+            self.stop_method = self.sink.close(self.stopped_at)
+        elif proc.poll() is not None:
+            self.stop_method = "exited"  # 兜底上限先到了 / 进程自己挂了
+        else:
+            try:
+                proc.send_signal(signal.CTRL_BREAK_EVENT if os.name == "nt" else signal.SIGINT)
+                proc.wait(timeout=self.cfg.capture_stop_timeout)
+                self.stop_method = "signal"
+            except Exception:
+                proc.terminate()
+                self.stop_method = "terminate"
+                try:
+                    proc.wait(timeout=3)
+                except Exception:
+                    proc.kill()
+                    self.stop_method = "kill"
+                    try:
+                        proc.wait(timeout=3)
+                    except Exception:
+                        pass
+
+        self.complete, self.packets = pcap_file_complete(self.filepath)
+        if not self.complete:
+            print(f"⚠️ 抓包文件尾部不完整（{self.stop_method}），可用的包: {self.packets}: {self.filepath}")
+
+        if self.tracker is not None and os.path.exists(self.filepath):
+            try:
+                self.filtered = filter_pcap_by_flows(self.filepath, self.tracker)
+                self.packets = self.filtered[0]
+                print(f"🧹 按进程过滤: 保留 {self.filtered[0]}/{self.filtered[1]} 个包"
+                      f"（{len(self.tracker.pids)} 个进程，{self.tracker.flow_count()} 条流）")
+            except OSError as e:
+                print(f"⚠️ 按进程过滤失败，保留整张网卡的流量: {e}")
+
+    def meta(self) -> dict:
+        return {
+            "started_at": _iso_ts(self.started_at),
+            "stopped_at": _iso_ts(self.stopped_at),
+            "seconds": round(self.stopped_at - self.started_at, 3)
+            if self.started_at and self.stopped_at else None,
+            "stop": self.stop_method,
+            "drops": self.sink.drops if self.sink is not None else None,
+            "complete": self.complete,
+            "packets": self.packets,
+            "media_timeline": None if self.timeline is None else {
+                "file": os.path.basename(self.timeline.writer.path),
+                "rows": self.timeline.writer.rows,
+            },
+            "devtools_log_failures": None if self.devtools is None else self.devtools.failures,
+            "demux": None if self.remotes is None else {
+                "remote_ips": sorted(self.remotes.ips),
+                "hosts": sorted(self.remotes.hosts),
+            },
+            "process_filter": None if self.tracker is None else {
+                "root_pid": self.tracker.root_pid,
+                "pids": len(self.tracker.pids),
+                "flows": self.tracker.flow_count(),
+                "kept": self.filtered[0] if self.filtered else None,
+                "total": self.filtered[1] if self.filtered else None,
+            },
+        }
 
 
 # ----------------------------
@@ -199,19 +1338,27 @@ def normalize_room_url(s: str) -> Optional[str]:
 # ----------------------------
 # ✅ Autoplay 遮罩 “真实鼠标点击”
 # ----------------------------
-def _move_mouse_to_player(driver):
-    try:
-        el = driver.find_element(By.CSS_SELECTOR, "video")
-        ActionChains(driver).move_to_element(el).perform()
-        return
-    except Exception:
-        pass
-    try:
-        el = driver.find_element(By.CSS_SELECTOR, "#room-html5-player, #__h5player, #douyu_room_normal_player_proxy_box")
-        ActionChains(driver).move_to_element(el).perform()
+# 鼠标悬停用的播放器元素（默认顺序；传入 SelectorStats 时按历史表现调整）
+DOUYU_PLAYER_SELECTORS = (
+    "video",
+    "#room-html5-player, #__h5player, #douyu_room_normal_player_proxy_box",
+)
+
+
+def _move_mouse_to_player(driver, stats: Optional["SelectorStats"] = None):
+    order = stats.order("player", DOUYU_PLAYER_SELECTORS) if stats is not None else DOUYU_PLAYER_SELECTORS
+    for sel in order:
+        t1 = time.time()
+        try:
+            el = driver.find_element(By.CSS_SELECTOR, sel)
+            ActionChains(driver).move_to_element(el).perform()
+        except Exception:
+            if stats is not None:
+                stats.report("player", sel, False, (time.time() - t1) * 1000)
+            continue
+        if stats is not None:
+            stats.report("player", sel, True, (time.time() - t1) * 1000)
         return
-    except Exception:
-        pass
 
 
 def _mouse_click_element(driver, el) -> bool:
@@ -252,16 +1399,58 @@ def douyu_mouse_click_autoplay_if_present(driver) -> bool:
     return False
 
 
-def douyu_autoplay_guard(driver, seconds: float = 8.0, interval: float = 0.25) -> int:
-    end = time.time() + seconds
-    cnt = 0
-    while time.time() < end:
-        if douyu_mouse_click_autoplay_if_present(driver):
-            cnt += 1
-            time.sleep(0.35)
-        else:
-            time.sleep(interval)
-    return cnt
+# 页面内 autoplay 遮罩检测：MutationObserver 装一次，只记录遮罩在不在、出现过几次；
+# 合成的 click 斗鱼播放器不认（isTrusted=false），真正的点击由 Python 用真实鼠标做
+DOUYU_AUTOPLAY_WATCHER_JS = r"""
+if (window.__lvAutoplay) return window.__lvAutoplay.seen;
+
+const state = window.__lvAutoplay = {present: false, seen: 0, pending: false, observer: null};
+
+function visible(el) {
+  if (!el || el.offsetParent === null) return false;
+  const r = el.getBoundingClientRect();
+  return r.width > 0 && r.height > 0;
+}
+
+// 和 douyu_mouse_click_autoplay_if_present 同样的选择器：图标 autoPlayImg、遮罩 autoplay
+function overlayShown() {
+  return ['[class*="autoPlayImg"]', '[class*="autoplay"]']
+    .some(sel => Array.from(document.querySelectorAll(sel)).some(visible));
+}
+
+function check() {
+  state.pending = false;
+  const shown = overlayShown();
+  if (shown && !state.present) state.seen++;
+  state.present = shown;
+}
+
+state.observer = new MutationObserver(() => {
+  if (state.pending) return;
+  state.pending = true;
+  setTimeout(check, 50);
+});
+state.observer.observe(document.documentElement, {
+  childList: true, subtree: true, attributes: true, attributeFilter: ['class', 'style'],
+});
+check();
+return state.seen;
+"""
+
+
+def install_douyu_autoplay_watcher(driver) -> None:
+    """重复安装是空操作（已装过就直接返回当前计数）。"""
+    try:
+        driver.execute_script(DOUYU_AUTOPLAY_WATCHER_JS)
+    except Exception as e:
+        print(f"⚠️ autoplay 遮罩监听安装失败: {e}")
+
+
+def douyu_autoplay_seen_count(driver) -> int:
+    try:
+        return int(driver.execute_script("return window.__lvAutoplay ? window.__lvAutoplay.seen : 0;") or 0)
+    except Exception:
+        return 0
 
 
 # ----------------------------
@@ -307,128 +1496,407 @@ def stop_douyu_hover_keepalive(driver):
     )
 
 
-def douyu_get_current_quality_text(driver, timeout=3) -> str:
-    el = WebDriverWait(driver, timeout).until(
-        EC.presence_of_element_located((By.CSS_SELECTOR, '[class*="rate-"] [class*="textLabel"]'))
-    )
-    return (el.text or "").strip()
+# ----------------------------
+# 选择器统计：记住每个控件选择器的成功率和耗时（EWMA），下次先试历史最快的；改版后失效的条目自动淘汰
+# ----------------------------
+class SelectorStats:
+    """
+    {platform: {role: {selector: {"ok", "fail", "fail_streak", "ewma_ms", "last_ok", "first_seen"}}}}
+    path 为 None 时只在进程内记忆；多个 worker 线程共用一个实例。
+    report 只改内存并标脏，flush 时才落盘（每个会话结束一次 + 进程退出一次）。
+    """
 
+    def __init__(self, path: Optional[str], platform: str = PLATFORM,
+                 stale_days: float = 14.0, evict_failures: int = 3, alpha: float = 0.3):
+        self.path = path
+        self.platform = platform
+        self.stale_seconds = stale_days * 86400
+        self.evict_failures = max(1, evict_failures)
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._data: Dict[str, dict] = {}
+        self._dirty = False
+        if path:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._data = json.load(f) or {}
+            except (OSError, ValueError):
+                self._data = {}
+        with self._lock:
+            for role in list(self._roles()):
+                self._evict(role)
+
+    def _roles(self) -> Dict[str, Dict[str, dict]]:
+        return self._data.setdefault(self.platform, {})
+
+    def _evict(self, role: str) -> None:
+        """连续失败太多次，或太久没成功过（页面改版）→ 丢掉统计，回到默认顺序重新学。"""
+        now = time.time()
+        entries = self._roles().get(role, {})
+        for sel, e in list(entries.items()):
+            last = e.get("last_ok") or e.get("first_seen") or now
+            if e.get("fail_streak", 0) >= self.evict_failures or now - last > self.stale_seconds:
+                del entries[sel]
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        try:
+            d = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(d, exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._data, f, ensure_ascii=False, indent=1)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"⚠️ 选择器统计写入失败: {e}")
+
+    def order(self, role: str, defaults) -> List[str]:
+        """成功过且最近没失败的按 EWMA 耗时升序 → 没有统计的按默认顺序 → 最近失败过的放最后。"""
+        defaults = list(defaults)
+        with self._lock:
+            entries = dict(self._roles().get(role, {}))
+        cands = defaults + [s for s in entries if s not in defaults]
+
+        def rank(sel: str):
+            e = entries.get(sel)
+            idx = defaults.index(sel) if sel in defaults else len(defaults)
+            if not e:
+                return (1, 0.0, idx)
+            if e.get("fail_streak", 0):
+                return (2, float(e["fail_streak"]), idx)
+            if e.get("ok", 0):
+                return (0, e.get("ewma_ms", 0.0), idx)
+            return (1, 0.0, idx)
+
+        return sorted(cands, key=rank)
+
+    def report(self, role: str, selector: str, ok: bool, ms: float) -> None:
+        now = time.time()
+        with self._lock:
+            entries = self._roles().setdefault(role, {})
+            e = entries.setdefault(selector, {"ok": 0, "fail": 0, "fail_streak": 0, "ewma_ms": None,
+                                              "last_ok": None, "first_seen": now})
+            if ok:
+                e["ok"] += 1
+                e["fail_streak"] = 0
+                e["last_ok"] = now
+                prev = e["ewma_ms"]
+                e["ewma_ms"] = ms if prev is None else (1 - self.alpha) * prev + self.alpha * ms
+            else:
+                e["fail"] += 1
+                e["fail_streak"] += 1
+            self._evict(role)
+            self._dirty = True
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._dirty:
+                self._save()
+                self._dirty = False
+
+
+_SELECTOR_STATS: Dict[str, SelectorStats] = {}
+_SELECTOR_STATS_LOCK = threading.Lock()
+
+
+def selector_stats(cfg: RunConfig) -> SelectorStats:
+    """同一个 selector_stats_path 在进程内只有一个实例（None = 只在内存里学）。"""
+    key = cfg.selector_stats_path or ""
+    with _SELECTOR_STATS_LOCK:
+        st = _SELECTOR_STATS.get(key)
+        if st is None:
+            st = SelectorStats(cfg.selector_stats_path, stale_days=cfg.selector_stale_days,
+                               evict_failures=cfg.selector_evict_failures)
+            _SELECTOR_STATS[key] = st
+            atexit.register(st.flush)
+        return st
 
-def douyu_open_quality_panel(driver, timeout=3) -> bool:
-    _move_mouse_to_player(driver)
 
-    try:
-        rate = WebDriverWait(driver, timeout).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, '[class*="rate-"]'))
-        )
-        ActionChains(driver).move_to_element(rate).perform()
-    except Exception:
-        return False
+# ----------------------------
+# 画质选择状态机：页面内一次 execute_async_script 完成：打开菜单 → 选最优可用档 → 点击 → 确认切换
+# ----------------------------
+# 斗鱼画质面板靠悬停展开，没有要点的按钮
+QUALITY_BUTTON_SELECTORS = ()
+
+QUALITY_HOOKS_JS = r"""
+// ---- 斗鱼：[class*="rate-"] 里的“画质”tip；面板靠真实鼠标悬停展开，点击不生效时交给 Python 真实点击 ----
+function vis(el) {
+  if (!el) return false;
+  const st = window.getComputedStyle(el);
+  if (!st || st.display === 'none' || st.visibility === 'hidden') return false;
+  return el.offsetParent !== null;
+}
+function rateBox() {
+  return Array.from(document.querySelectorAll('[class*="rate-"]'))
+    .find(el => el.querySelector('[class*="textLabel"]')) || null;
+}
+function qualityTip() {
+  const rate = rateBox();
+  if (!rate) return null;
+  for (const t of rate.querySelectorAll('[class*="tip"]')) {
+    const ok = Array.from(t.querySelectorAll('input')).some(i => (i.value || '').trim().startsWith('画质'));
+    if (ok && vis(t)) return t;
+  }
+  return null;
+}
+const H = {
+  confirmMs: 3000,
+  optimistic: false,
+  menuOpen: () => !!qualityTip(),
+  openMenu: () => {
+    const rate = rateBox();
+    if (!rate) return;
+    const r = rate.getBoundingClientRect();
+    ['mousemove', 'mouseover', 'mouseenter'].forEach(type => {
+      rate.dispatchEvent(new MouseEvent(type, {bubbles: true, clientX: r.left + 5, clientY: r.top + 5}));
+    });
+  },
+  ladder: () => {
+    const tip = qualityTip();
+    if (!tip) return [];
+    const qItem = Array.from(tip.querySelectorAll('[class*="tipItem"]')).find(it => {
+      const inp = it.querySelector('input');
+      return inp && (inp.value || '').trim().startsWith('画质');
+    });
+    if (!qItem) return [];
+    return Array.from(qItem.querySelectorAll('ul li'))
+      .map(li => ({el: li, label: (li.innerText || '').trim()}))
+      .filter(i => i.label && !i.label.includes('画质增强'))
+      .map(i => Object.assign(i, {gated: /登录|扫码|贵族|会员/.test(i.label)}));
+  },
+  match: (label, q) => !!label && label.includes(q),
+  current: () => {
+    const rate = rateBox();
+    const el = rate && rate.querySelector('[class*="textLabel"]');
+    return el ? (el.innerText || '').trim() : '';
+  },
+  click: (el) => el.click(),
+};
+"""
 
-    try:
-        def panel_visible(d):
-            return d.execute_script(r"""
-                function isVisible(el){
-                  if(!el) return false;
-                  const st = window.getComputedStyle(el);
-                  if(!st) return false;
-                  if(st.display === 'none' || st.visibility === 'hidden') return false;
-                  return (el.offsetParent !== null);
-                }
-                const rate = Array.from(document.querySelectorAll('[class*="rate-"]'))
-                          .find(el => el.querySelector('[class*="textLabel"]')) || null;
-                if(!rate) return false;
-                const tips = Array.from(rate.querySelectorAll('[class*="tip"]'));
-                for(const t of tips){
-                  const inputs = Array.from(t.querySelectorAll('input'));
-                  const ok = inputs.some(i => (i.value||'').trim().startsWith('画质'));
-                  if(ok && isVisible(t)) return true;
-                }
-                return false;
-            """)
-        WebDriverWait(driver, timeout).until(panel_visible)
-        return True
-    except Exception:
-        return False
+QUALITY_MACHINE_JS = r"""
+// ---- 通用状态机：open → pick → click → confirm；全程受 deadlineMs 约束，一次调用返回结果 ----
+const preferred = arguments[0], deadlineMs = arguments[1], opts = arguments[2] || {};
+const done = arguments[arguments.length - 1];
+const t0 = performance.now();
+const left = () => deadlineMs - (performance.now() - t0);
+const sleep = (ms) => new Promise(r => setTimeout(r, ms));
+
+async function until(fn, ms) {
+  const end = performance.now() + Math.max(0, Math.min(ms, left()));
+  while (performance.now() < end) {
+    const v = fn();
+    if (v) return v;
+    await sleep(80);
+  }
+  return fn();
+}
+
+const failed = new Set(opts.exclude || []);
+const attempts = {};
+const confirmMs = opts.confirmMs || H.confirmMs;
+// skipClick：点击已在页面外（真实鼠标）完成，只确认 preferred[0] 是否生效
+let state = opts.skipClick ? 'confirm' : 'open';
+let kw = opts.skipClick ? preferred[0] : null;
+let opens = 0, target = null, ladder = [];
+
+// 打开菜单的按钮选择器：按 Python 传进来的历史顺序（最快的在前）逐个试；点了没反应的本次不再用
+const buttons = opts.buttonSelectors || [];
+const badButtons = new Set();
+const selectorHits = [];
+function clickButton() {
+  for (const sel of buttons) {
+    if (badButtons.has(sel)) continue;
+    const el = document.querySelector(sel);
+    if (el) { el.click(); return sel; }
+  }
+  return null;
+}
+
+function finish(ok, reason) {
+  done({
+    ok: ok, reason: reason, picked: ok ? kw : null, want: kw,
+    current: H.current(), ladder: ladder.map(i => ({label: i.label, gated: !!i.gated})), opens: opens,
+    selectorHits: selectorHits,
+    ms: Math.round(performance.now() - t0),
+    target: (!ok && target) ? target.el : null,
+  });
+}
+
+(async () => {
+  try {
+    while (left() > 0) {
+      if (state === 'open') {
+        opens++;
+        const t1 = performance.now();
+        let sel = null;
+        if (!H.menuOpen()) {
+          if (H.openMenu) H.openMenu(); else sel = clickButton();
+        }
+        const opened = await until(H.menuOpen, 2000);
+        if (sel) {
+          selectorHits.push({selector: sel, ok: !!opened, ms: Math.round(performance.now() - t1)});
+          if (!opened) badButtons.add(sel);
+        }
+        if (opened) { state = opts.probe ? 'probe' : 'pick'; continue; }
+        if (opens >= 3) return finish(false, 'menu_not_open');
+        continue;
+      }
+
+      // probe：只读出房间实际提供的整条画质阶梯（受限档标 gated），不点击
+      if (state === 'probe') {
+        ladder = H.ladder();
+        return finish(true, 'probed');
+      }
+
+      if (state === 'pick') {
+        ladder = H.ladder();
+        const items = ladder.filter(i => !i.gated);
+        target = null;
+        for (const q of preferred) {
+          if (failed.has(q)) continue;
+          const it = items.find(i => H.match(i.label, q));
+          if (it) { target = it; kw = q; break; }
+        }
+        if (!target) return finish(false, items.length ? 'no_preferred' : 'empty_menu');
+        if (H.match(H.current(), kw)) return finish(true, 'already');
+        state = 'click';
+        continue;
+      }
+
+      if (state === 'click') {
+        H.click(target.el);
+        state = 'confirm';
+        continue;
+      }
+
+      if (state === 'confirm') {
+        if (await until(() => H.match(H.current(), kw), confirmMs)) return finish(true, 'confirmed');
+        if (H.optimistic) return finish(true, 'unconfirmed');
+        if (opts.noRetry) return finish(false, 'not_confirmed');
+        // 同一档最多试 2 次，之后换下一个偏好
+        attempts[kw] = (attempts[kw] || 0) + 1;
+        if (attempts[kw] >= 2) failed.add(kw);
+        state = 'open';
+        continue;
+      }
+    }
+    finish(false, 'deadline');
+  } catch (e) {
+    done({ok: false, reason: 'error: ' + e, picked: null, selectorHits: selectorHits,
+          ms: Math.round(performance.now() - t0)});
+  }
+})();
+"""
 
+QUALITY_SELECT_JS = QUALITY_HOOKS_JS + QUALITY_MACHINE_JS
 
-def douyu_click_quality(driver, keyword: str) -> bool:
-    js_find = r"""
-    const kw = arguments[0];
-    function isVisible(el){
-      if(!el) return false;
-      const st = window.getComputedStyle(el);
-      if(!st) return false;
-      if(st.display === 'none' || st.visibility === 'hidden') return false;
-      return (el.offsetParent !== null);
-    }
-    const rate = Array.from(document.querySelectorAll('[class*="rate-"]'))
-              .find(el => el.querySelector('[class*="textLabel"]')) || null;
-    if(!rate) return null;
-
-    const tips = Array.from(rate.querySelectorAll('[class*="tip"]'));
-    let visibleTip = null;
-    for(const t of tips){
-      const inputs = Array.from(t.querySelectorAll('input'));
-      const ok = inputs.some(i => (i.value||'').trim().startsWith('画质'));
-      if(ok && isVisible(t)){ visibleTip = t; break; }
-    }
-    if(!visibleTip) return null;
 
-    const items = Array.from(visibleTip.querySelectorAll('[class*="tipItem"]'));
-    let qItem = null;
-    for(const it of items){
-      const inp = it.querySelector('input');
-      if(inp && (inp.value||'').trim().startsWith('画质')){ qItem = it; break; }
-    }
-    if(!qItem) return null;
+def run_quality_machine(driver, preferred, deadline: float, opts: Optional[dict] = None,
+                        stats: Optional[SelectorStats] = None) -> dict:
+    """
+    返回 {"ok", "reason", "picked", "want", "current", "ladder", "opens", "ms", "target"}；
+    opts={"probe": True} 时只打开菜单读出画质阶梯（reason="probed"），不点击。
+    超过 deadline 秒页面内自行收尾返回，不会卡住会话。
+    """
+    deadline = max(0.5, deadline)
+    opts = dict(opts or {})
+    opts["buttonSelectors"] = (stats.order("quality_button", QUALITY_BUTTON_SELECTORS)
+                               if stats is not None else list(QUALITY_BUTTON_SELECTORS))
+    driver.set_script_timeout(deadline + 5)
+    r = driver.execute_async_script(QUALITY_SELECT_JS, list(preferred), int(deadline * 1000), opts) or {}
+    if stats is not None:
+        for h in r.get("selectorHits") or []:
+            stats.report("quality_button", h["selector"], bool(h.get("ok")), float(h.get("ms") or 0))
+    return r
+
+
+def _log_quality_result(r: dict) -> None:
+    print(f"🎚️ 画质状态机: {r.get('reason')}，用时 {r.get('ms', 0) / 1000:.1f}s，"
+          f"开菜单 {r.get('opens', 0)} 次")
+
+
+def quality_matches(label: str, q: str) -> bool:
+    """与页面内 H.match 一致：包含关键字。"""
+    return bool(label) and q in label
 
-    const lis = Array.from(qItem.querySelectorAll('ul li')).filter(li => {
-      const txt = (li.innerText||'').trim();
-      if(!txt) return false;
-      if(txt.includes('画质增强')) return false;
-      return true;
-    });
 
-    const target = lis.find(li => (li.innerText||'').includes(kw));
-    return target || null;
+def pick_quality_order(ladder: List[dict], preferred) -> List[str]:
     """
-    try:
-        el = driver.execute_script(js_find, keyword)
-        if not el:
-            return False
-        return _mouse_click_element(driver, el)
-    except Exception:
-        return False
+    按偏好顺序列出房间实际提供（且未受限）的档位：第一个就是要选的，后面的是确认失败时的候补。
+    只依赖 ladder 和 preferred，结果是确定的。
+    """
+    usable = [i["label"] for i in ladder if not i.get("gated")]
+    return [q for q in preferred if any(quality_matches(label, q) for label in usable)]
 
 
-def douyu_wait_quality_changed(driver, keyword: str, timeout=3) -> bool:
+def _log_ladder(ladder: List[dict], order: List[str]) -> None:
+    usable = [i["label"] for i in ladder if not i.get("gated")]
+    gated = [i["label"] for i in ladder if i.get("gated")]
+    print(f"📶 画质阶梯: {usable}" + (f"（受限: {gated}）" if gated else "") + f" → 候选 {order}")
+
+
+def _douyu_hover_rate(driver, stats: Optional[SelectorStats] = None) -> None:
+    _move_mouse_to_player(driver, stats)
     try:
-        WebDriverWait(driver, timeout, poll_frequency=0.1).until(
-            lambda d: keyword in douyu_get_current_quality_text(d, timeout=2)
-        )
-        return True
+        rate = driver.find_element(By.CSS_SELECTOR, '[class*="rate-"]')
+        ActionChains(driver).move_to_element(rate).perform()
     except Exception:
-        return False
+        pass
 
 
-def select_quality_douyu_fast(driver, preferred=("原画", "蓝光", "超清", "高清")) -> Optional[str]:
+def select_quality_douyu_fast(driver, preferred=("原画", "蓝光", "超清", "高清"), deadline: float = 10.0,
+                              stats: Optional[SelectorStats] = None) -> dict:
+    """
+    斗鱼面板靠 :hover 展开、合成 click 有时不生效：
+    先真实鼠标悬停，页面内读出画质阶梯并按偏好排好候选；确认失败时退回真实鼠标点击 + 页面内确认。
+    返回 {"picked", "ladder"}。
+    """
     start_douyu_hover_keepalive(driver, interval_ms=220)
+    end = time.time() + deadline
+    ladder: List[dict] = []
+    order: Optional[List[str]] = None
+    exclude: List[str] = []
     try:
-        for q in preferred:
-            for _ in range(2):
-                douyu_mouse_click_autoplay_if_present(driver)
-
-                if not douyu_open_quality_panel(driver, timeout=3):
-                    continue
-                if not douyu_click_quality(driver, q):
-                    continue
-                if douyu_wait_quality_changed(driver, q, timeout=3):
-                    try:
-                        return douyu_get_current_quality_text(driver, timeout=2)
-                    except Exception:
-                        return q
-        return None
+        while time.time() < end - 0.5:
+            douyu_mouse_click_autoplay_if_present(driver)
+            _douyu_hover_rate(driver, stats)
+
+            if order is None:
+                probe = run_quality_machine(driver, preferred, end - time.time(), {"probe": True}, stats=stats)
+                ladder = probe.get("ladder") or []
+                if ladder:
+                    order = pick_quality_order(ladder, preferred)
+                    _log_ladder(ladder, order)
+                else:
+                    # 没读出阶梯（菜单没开 / 探测超时）：按偏好顺序直接让状态机去选，用剩下的时间
+                    print(f"📶 没读出画质阶梯（{probe.get('reason')}），按偏好 {list(preferred)} 直接选")
+                    order = list(preferred)
+            candidates = [q for q in order if q not in exclude]
+            if not candidates:
+                break
+
+            r = run_quality_machine(driver, candidates, end - time.time(),
+                                    {"noRetry": True, "confirmMs": 1200}, stats=stats)
+            _log_quality_result(r)
+            ladder = ladder or r.get("ladder") or []
+            if r.get("ok"):
+                return {"picked": r.get("current") or r.get("picked"), "ladder": ladder}
+            if r.get("reason") in ("menu_not_open", "empty_menu"):
+                continue
+            if r.get("reason") != "not_confirmed" or r.get("target") is None:
+                break
+
+            want = r["want"]
+            if _mouse_click_element(driver, r["target"]):
+                r = run_quality_machine(driver, [want], end - time.time(),
+                                        {"noRetry": True, "skipClick": True}, stats=stats)
+                _log_quality_result(r)
+                if r.get("ok"):
+                    return {"picked": r.get("current") or want, "ladder": ladder}
+            exclude.append(want)
+        return {"picked": None, "ladder": ladder}
     finally:
         stop_douyu_hover_keepalive(driver)
 
@@ -436,31 +1904,209 @@ def select_quality_douyu_fast(driver, preferred=("原画", "蓝光", "超清", "
 # ----------------------------
 # 分类页抓房间（简易）
 # ----------------------------
-def scroll_to_load(driver, rounds: int = 8):
-    for _ in range(rounds):
-        driver.execute_script("window.scrollBy(0, document.documentElement.clientHeight * 0.9);")
-        time.sleep(0.8)
+# 第一次调用：扫一遍现有 <a>，再挂 MutationObserver，之后新渲染出来的卡片在页面里增量收集、去重
+# 返回当前已收集数量；房间列表最后一次性取回
+ROOM_COLLECTOR_JS = r"""
+const normalize = %s;
+if (!window.__lvRooms) {
+  const st = window.__lvRooms = {seen: new Set(), list: [], observer: null};
+  const add = (a) => {
+    const u = normalize((a.href || '').trim());
+    if (u && !st.seen.has(u)) { st.seen.add(u); st.list.push(u); }
+  };
+  const scan = (node) => {
+    if (!node || node.nodeType !== 1) return;
+    if (node.matches('a[href]')) add(node);
+    node.querySelectorAll('a[href]').forEach(add);
+  };
+  scan(document.documentElement);
+  st.observer = new MutationObserver((muts) => {
+    for (const m of muts) {
+      if (m.type === 'attributes') scan(m.target);
+      else m.addedNodes.forEach(scan);
+    }
+  });
+  st.observer.observe(document.documentElement,
+                      {childList: true, subtree: true, attributes: true, attributeFilter: ['href']});
+}
+return window.__lvRooms.list.length;
+""" % ROOM_NORMALIZE_JS.strip()
+
+
+def install_room_collector(driver) -> int:
+    return int(driver.execute_script(ROOM_COLLECTOR_JS) or 0)
+
+
+def collected_room_count(driver) -> int:
+    return int(driver.execute_script("return window.__lvRooms ? window.__lvRooms.list.length : 0;") or 0)
+
+
+def take_collected_rooms(driver, limit: int) -> List[str]:
+    return driver.execute_script("""
+        const st = window.__lvRooms;
+        if (!st) return [];
+        if (st.observer) st.observer.disconnect();
+        return st.list.slice(0, arguments[0]);
+    """, limit) or []
+
+
+# 自适应滚动（execute_async_script，一次调用跑完）：
+# - 新卡片渲染出来（DOM 变化）就马上进入下一轮滚动，不再固定 sleep
+# - 收满 limit / 连续几轮没有新房间（到底了）/ 超过总时长 / 轮数用完 就结束
+ADAPTIVE_SCROLL_JS = r"""
+const [limit, idleMs, maxMs, maxStale, maxRounds] = arguments;
+const done = arguments[arguments.length - 1];
+const st = window.__lvRooms || {list: []};
+const t0 = performance.now();
+let rounds = 0, stale = 0, finished = false, timer = null, fastPending = false;
+let lastCount = st.list.length;
+let lastHeight = document.documentElement.scrollHeight;
+
+const finish = (reason) => {
+  if (finished) return;
+  finished = true;
+  clearTimeout(timer);
+  clearTimeout(hardStop);
+  obs.disconnect();
+  done({count: st.list.length, rounds: rounds, reason: reason,
+        elapsed_ms: Math.round(performance.now() - t0)});
+};
+
+const step = () => {
+  if (finished) return;
+  const count = st.list.length;
+  const height = document.documentElement.scrollHeight;
+  if (count >= limit) return finish('limit');
+  if (rounds >= maxRounds) return finish('max_rounds');
+
+  if (count > lastCount || height > lastHeight) stale = 0;
+  else if (rounds > 0) stale += 1;
+  if (stale >= maxStale) return finish('end_of_feed');
+  lastCount = count;
+  lastHeight = height;
+
+  window.scrollBy(0, document.documentElement.clientHeight * 0.9);
+  rounds += 1;
+  clearTimeout(timer);
+  timer = setTimeout(step, idleMs);
+};
+
+// 有新节点插入：稍等一下让这一批渲染完，再滚下一轮（只提前，不无限推迟）
+const obs = new MutationObserver((muts) => {
+  if (finished || fastPending) return;
+  if (!muts.some(m => m.addedNodes && m.addedNodes.length)) return;
+  fastPending = true;
+  clearTimeout(timer);
+  timer = setTimeout(() => { fastPending = false; step(); }, 150);
+});
+obs.observe(document.body || document.documentElement, {childList: true, subtree: true});
+const hardStop = setTimeout(() => finish('timeout'), maxMs);
+step();
+"""
+
+
+def adaptive_scroll_collect(driver, limit: int, max_rounds: int = 10, max_seconds: float = 20.0,
+                            idle_ms: int = 1500, max_stale_rounds: int = 3) -> dict:
+    driver.set_script_timeout(max_seconds + 5)
+    return driver.execute_async_script(
+        ADAPTIVE_SCROLL_JS, limit, idle_ms, int(max_seconds * 1000), max_stale_rounds, max_rounds
+    ) or {}
 
 
 def get_live_rooms_in_category_douyu(driver, category_url: str, limit: int = 10) -> List[str]:
     driver.get(category_url)
     WebDriverWait(driver, 20).until(lambda d: d.execute_script("return document.readyState") == "complete")
-    time.sleep(2)
 
-    rooms: Set[str] = set()
+    # 房间链接在页面里收集/规范化/去重；滚动由页面内自适应脚本驱动（新卡片一出现就滚下一轮）
+    t0 = time.time()
+    stats = {}
+    if install_room_collector(driver) < limit:
+        stats = adaptive_scroll_collect(driver, limit, max_rounds=14)
+    rooms = take_collected_rooms(driver, limit)
+
+    print(f"🔎 房间发现: {len(rooms)} 间，用时 {time.time() - t0:.1f}s"
+          f"（滚动 {stats.get('rounds', 0)} 轮，结束: {stats.get('reason', 'limit')}）")
+    return rooms
 
-    for _ in range(14):
-        anchors = driver.find_elements(By.CSS_SELECTOR, "a[href]")
-        for a in anchors:
-            href = (a.get_attribute("href") or "").strip()
-            href = href.split("?")[0].rstrip("/")
-            if ROOM_RE.match(href) or ROOM_RE.match(href + "/"):
-                rooms.add(href)
-                if len(rooms) >= limit:
-                    return list(rooms)[:limit]
-        scroll_to_load(driver, rounds=1)
 
-    return list(rooms)[:limit]
+# ----------------------------
+# 不开浏览器的房间发现：直接调平台的列表 JSON 接口（keep-alive 连接池）
+# ----------------------------
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Accept": "application/json, text/plain, */*",
+    "Referer": LIVE_HOME,
+}
+
+_HTTP_POOL: Optional[urllib3.PoolManager] = None
+_HTTP_POOL_LOCK = threading.Lock()
+
+
+def http_pool() -> urllib3.PoolManager:
+    global _HTTP_POOL
+    with _HTTP_POOL_LOCK:
+        if _HTTP_POOL is None:
+            _HTTP_POOL = urllib3.PoolManager(
+                num_pools=4,
+                maxsize=8,
+                headers=HTTP_HEADERS,
+                timeout=urllib3.Timeout(connect=3.0, read=8.0),
+                retries=urllib3.Retry(total=2, backoff_factor=0.3, status_forcelist=(502, 503, 504)),
+            )
+        return _HTTP_POOL
+
+
+def http_get_json(url: str, params: Optional[dict] = None) -> dict:
+    r = http_pool().request("GET", url, fields=params)
+    if r.status != 200:
+        raise RuntimeError(f"HTTP {r.status}: {url}")
+    return json.loads(r.data.decode("utf-8"))
+
+
+def get_live_rooms_http(cfg: RunConfig, category_url: str, limit: int = 10) -> Optional[List[str]]:
+    """
+    discovery_backend == "http" 时走列表接口；返回 None 表示不可用（分类不支持 / 接口失败），调用方回退 Selenium。
+    """
+    if cfg.discovery_backend != "http":
+        return None
+    t0 = time.time()
+    try:
+        rooms = fetch_rooms_http(category_url, limit, base=cfg.discovery_api_base)
+    except Exception as e:
+        print(f"⚠️ 列表接口发现失败，回退浏览器: {type(e).__name__}: {e}")
+        return None
+    print(f"🔎 房间发现(HTTP): {len(rooms)} 间，用时 {time.time() - t0:.1f}s")
+    return rooms
+
+
+API_BASE = "https://m.douyu.com"
+
+
+def fetch_rooms_http(category_url: str, limit: int, base: Optional[str] = None) -> List[str]:
+    """g_xxx 分区背后的列表接口：m.douyu.com/api/room/list?type=<xxx>（按 page 分页，返回 rid）"""
+    m = re.search(r"douyu\.com/g_([A-Za-z0-9]+)", category_url)
+    if not m:
+        raise ValueError(f"不是 g_xxx 分区 URL: {category_url}")
+    short_name = m.group(1)
+    base = (base or API_BASE).rstrip("/")
+
+    rooms: List[str] = []
+    for page in range(1, 11):
+        data = http_get_json(f"{base}/api/room/list", {"page": page, "type": short_name})
+        if data.get("code") != 0:
+            raise RuntimeError(f"接口返回 code={data.get('code')} {data.get('msg', '')}")
+        body = data.get("data") or {}
+        items = body.get("list") or []
+        for it in items:
+            url = normalize_room_url(str(it.get("rid") or ""))
+            if url and url not in rooms:
+                rooms.append(url)
+                if len(rooms) >= limit:
+                    return rooms
+        if not items or page >= int(body.get("pageCount") or page):
+            break
+    return rooms
 
 
 # ----------------------------
@@ -486,93 +2132,1764 @@ def get_categories_douyu_simple(driver) -> Dict[str, str]:
     return cats
 
 
+# ----------------------------
+# 按进程归属过滤：chromedriver 起的整棵进程树 → 打开的 socket inode → /proc/<pid>/net 里的五元组，
+# 停止抓包后只把属于这棵进程树的包留在 pcap 里（系统更新、其它程序、其它会话的浏览器都剔掉）
+# ----------------------------
+def _proc_net_addr(field: str) -> Tuple[str, int]:
+    """/proc/net/tcp 的 "0100007F:1F90"：IPv4 是主机字节序的 u32，IPv6 是 4 个主机字节序 u32。"""
+    ip_hex, port_hex = field.split(":")
+    raw = bytes.fromhex(ip_hex)
+    if len(raw) == 4:
+        ip = socket.inet_ntop(socket.AF_INET, raw[::-1])
+    else:
+        ip = socket.inet_ntop(socket.AF_INET6, b"".join(raw[i:i + 4][::-1] for i in range(0, 16, 4)))
+    return _norm_ip(ip), int(port_hex, 16)
+
+
+WILDCARD_IPS = frozenset({"0.0.0.0", "::"})
+
+
+def _norm_ip(ip: str) -> str:
+    # tcp6 上的 IPv4 连接显示成 ::ffff:a.b.c.d，抓到的包是 IPv4
+    return ip[7:] if ip.startswith("::ffff:") and "." in ip else ip
+
+
+def packet_ips(linktype: int, data: bytes) -> Optional[Tuple[int, str, str, Optional[int]]]:
+    """链路层 → IPv4/IPv6；返回 (协议号, src, dst, 传输层偏移)，非首个分片的偏移为 None，认不出来返回 None。"""
+    try:
+        if linktype == 1:                        # Ethernet（跳过 VLAN 标签）
+            etype, off = int.from_bytes(data[12:14], "big"), 14
+            while etype in (0x8100, 0x88A8):
+                etype, off = int.from_bytes(data[off + 2:off + 4], "big"), off + 4
+        elif linktype == 113:                    # Linux cooked (SLL)
+            etype, off = int.from_bytes(data[14:16], "big"), 16
+        elif linktype == 276:                    # Linux cooked v2 (SLL2)
+            etype, off = int.from_bytes(data[0:2], "big"), 20
+        elif linktype in (12, 14, 101):          # Raw IP
+            etype, off = {4: 0x0800, 6: 0x86DD}.get(data[0] >> 4, 0), 0
+        elif linktype == 0:                      # BSD loopback：4 字节地址族
+            etype = 0x0800 if int.from_bytes(data[:4], "little") == 2 else 0x86DD
+            off = 4
+        else:
+            return None
+
+        l4: Optional[int]
+        if etype == 0x0800:
+            proto = data[off + 9]
+            src = socket.inet_ntop(socket.AF_INET, data[off + 12:off + 16])
+            dst = socket.inet_ntop(socket.AF_INET, data[off + 16:off + 20])
+            l4 = off + (data[off] & 0x0F) * 4
+            if int.from_bytes(data[off + 6:off + 8], "big") & 0x1FFF:
+                l4 = None                        # 非首个分片没有端口
+        elif etype == 0x86DD:
+            proto = data[off + 6]
+            src = socket.inet_ntop(socket.AF_INET6, data[off + 8:off + 24])
+            dst = socket.inet_ntop(socket.AF_INET6, data[off + 24:off + 40])
+            l4 = off + 40
+            while proto in (0, 43, 60):          # hop-by-hop / routing / destination options
+                proto, l4 = data[l4], l4 + (data[l4 + 1] + 1) * 8
+            if proto == 44:
+                l4 = None
+        else:
+            return None
+        return proto, _norm_ip(src), _norm_ip(dst), l4
+    except (IndexError, ValueError):
+        return None
+
+
+def packet_five_tuple(linktype: int, data: bytes) -> Optional[Tuple[str, str, int, str, int]]:
+    """在 packet_ips 基础上取 TCP/UDP 端口；返回 (proto, src, sport, dst, dport)，认不出来返回 None。"""
+    l3 = packet_ips(linktype, data)
+    if l3 is None:
+        return None
+    proto, src, dst, l4 = l3
+    if l4 is None or proto not in (6, 17) or len(data) < l4 + 4:
+        return None
+    sport, dport = int.from_bytes(data[l4:l4 + 2], "big"), int.from_bytes(data[l4 + 2:l4 + 4], "big")
+    return ("tcp" if proto == 6 else "udp"), src, sport, dst, dport
+
+
+class ProcessFlowTracker:
+    """
+    后台线程每 interval 秒扫一次 /proc：进程树（按 ppid 从根往下找）→ fd 里的 socket:[inode] →
+    /proc/<pid>/net/{tcp,tcp6,udp,udp6} 里对应的本地地址和远端地址。见过的流一直记着（连接关了也算这个会话的）。
+    """
+
+    def __init__(self, root_pid: int, interval: float = 0.5):
+        self.root_pid = root_pid
+        self.interval = interval
+        self.pids: Set[int] = set()
+        # (proto, 本地端口) → {远端 (ip, port)}：connect 过的 socket
+        self.flows: Dict[Tuple[str, int], Set[Tuple[str, int]]] = {}
+        # (proto, 本地端口) → {绑定的本地地址}：没 connect 的 UDP（QUIC / DNS）等；对端由发出去的包钉住
+        self.unconnected: Dict[Tuple[str, int], Set[str]] = {}
+        self.peers: Dict[Tuple[str, int], Set[Tuple[str, int]]] = {}
+        # 进程树的 socket 上见过的具体本地地址：绑在 0.0.0.0 / :: 上的 socket 靠它认出本机这一端
+        self.local_ips: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.refresh()
+        self._thread = threading.Thread(target=self._loop, name="flow-tracker", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        self.refresh()    # 浏览器还没关，再扫最后一次
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"⚠️ 进程流表刷新失败: {e}")
+
+    def _descendants(self) -> Set[int]:
+        children: Dict[int, List[int]] = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/stat", "r") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(name))
+        out: Set[int] = set()
+        todo = [self.root_pid]
+        while todo:
+            pid = todo.pop()
+            if pid not in out:
+                out.add(pid)
+                todo.extend(children.get(pid, []))
+        return out
+
+    @staticmethod
+    def _socket_inodes(pids: Set[int]) -> Set[int]:
+        inodes: Set[int] = set()
+        for pid in pids:
+            try:
+                fds = os.listdir(f"/proc/{pid}/fd")
+            except OSError:
+                continue
+            for fd in fds:
+                try:
+                    target = os.readlink(f"/proc/{pid}/fd/{fd}")
+                except OSError:
+                    continue
+                if target.startswith("socket:["):
+                    inodes.add(int(target[8:-1]))
+        return inodes
+
+    def refresh(self) -> None:
+        pids = self._descendants()
+        inodes = self._socket_inodes(pids)
+        found: List[Tuple[Tuple[str, int], str, Optional[Tuple[str, int]]]] = []
+        if inodes:
+            # 用进程树自己的 /proc/<pid>/net（和浏览器同一个网络命名空间）
+            net_dir = next((f"/proc/{p}/net" for p in sorted(pids) if os.path.isdir(f"/proc/{p}/net")), "/proc/net")
+            for proto, names in (("tcp", ("tcp", "tcp6")), ("udp", ("udp", "udp6"))):
+                for fn in names:
+                    try:
+                        with open(os.path.join(net_dir, fn), "r") as f:
+                            rows = f.read().splitlines()[1:]
+                    except OSError:
+                        continue
+                    for row in rows:
+                        parts = row.split()
+                        if len(parts) < 10 or int(parts[9]) not in inodes:
+                            continue
+                        local, remote = _proc_net_addr(parts[1]), _proc_net_addr(parts[2])
+                        found.append(((proto, local[1]), local[0], remote if remote[1] else None))
+        with self._lock:
+            self.pids |= pids
+            for key, local_ip, remote in found:
+                if remote is None:
+                    self.unconnected.setdefault(key, set()).add(local_ip)
+                else:
+                    self.flows.setdefault(key, set()).add(remote)
+                if local_ip not in WILDCARD_IPS:
+                    self.local_ips.add(local_ip)
+
+    def owns(self, five: Tuple[str, str, int, str, int]) -> bool:
+        """
+        connect 过的流按 本地端口 + 远端地址 认。没 connect 的 socket 只认本机这一端：
+        从它的端口、它的本地地址发出去的包算它的，并把目的地址钉成对端；发到它的包只有来自钉住的对端才算。
+        所以要按包的时间顺序调用（filter_pcap_by_flows 就是顺着文件走的）。
+        """
+        proto, src, sport, dst, dport = five
+        with self._lock:
+            if (dst, dport) in self.flows.get((proto, sport), ()) or (src, sport) in self.flows.get((proto, dport), ()):
+                return True
+            bound = self.unconnected.get((proto, sport))
+            if bound and self._is_local(src, bound):
+                self.peers.setdefault((proto, sport), set()).add((dst, dport))
+                return True
+            bound = self.unconnected.get((proto, dport))
+            if bound and self._is_local(dst, bound):
+                return (src, sport) in self.peers.get((proto, dport), ())
+        return False
+
+    def _is_local(self, ip: str, bound: Set[str]) -> bool:
+        if ip in bound:
+            return True
+        # 绑在通配地址上：是本机地址就行（一个具体本地地址都没见过时没法判断，放行）
+        return bool(bound & WILDCARD_IPS) and (not self.local_ips or ip in self.local_ips)
+
+    def flow_count(self) -> int:
+        with self._lock:
+            return sum(len(v) for v in self.flows.values()) + len(self.unconnected)
+
+
+def devtools_events_wanted(cfg: RunConfig) -> bool:
+    """分流 / 流标注 / 媒体时间线任一打开，就要让 chromedriver 记 performance 日志。"""
+    return cfg.capture_demux == "devtools" or cfg.flow_labels or cfg.media_timeline
+
+
+class DevtoolsNetworkLog:
+    """
+    一个会话一个：后台线程每秒读一次 DevTools performance 日志，把 Network.* 事件按顺序分发给订阅者。
+    chromedriver 的日志读一次清一次，所以分流、流标注、媒体时间线共用这一个读者。
+    页面在跑 execute_async_script 时 chromedriver 会让这个读取排队，所以还没认领的包要在引擎里压一会儿（capture_demux_hold）。
+    """
+
+    def __init__(self, driver, listeners: List, interval: float = 1.0):
+        self.driver = driver
+        self.listeners = listeners
+        self.interval = interval
+        self.failures = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _read(self) -> List[dict]:
+        """
+        直接发 getLog 命令：netns 模式的 driver 是 webdriver.Remote，没有 get_log 方法，chromedriver 照样支持这个命令。
+        读不到时只在第一次大声报一次（后面每秒都会失败），次数进 meta。
+        """
+        try:
+            return self.driver.execute("getLog", {"type": "performance"})["value"] or []
+        except Exception as e:
+            self.failures += 1
+            if self.failures == 1:
+                print(f"⚠️ 读不到 DevTools performance 日志（{type(e).__name__}: {e}），"
+                      f"本会话的分流 IP / 流标注 / 媒体时间线会缺数据")
+            return []
+
+    def start(self) -> None:
+        self._read()    # 热浏览器里还攒着上一个房间的事件，先清掉
+        self._thread = threading.Thread(target=self._loop, name="devtools-network", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            # 不设超时：线程里唯一的阻塞调用是 getLog，受 WebDriver 客户端超时约束；
+            # 必须等它退出再收最后一次，订阅者（媒体时间线）随后才能安全地落盘、关文件
+            self._thread.join()
+        self.poll()    # 浏览器还没关，收最后一次
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+    def poll(self) -> None:
+        for e in self._read():
+            try:
+                msg = json.loads(e["message"])["message"]
+            except (KeyError, TypeError, ValueError):
+                continue
+            method = msg.get("method") or ""
+            if not method.startswith("Network."):
+                continue
+            params = msg.get("params") or {}
+            for fn in self.listeners:
+                fn(method, params)
+
+
+def _devtools_ip(raw: Optional[str]) -> Optional[str]:
+    """DevTools 的 remoteIPAddress（IPv6 带方括号）→ 和抓包里一致的写法；::ffff:a.b.c.d 抓到的包是 IPv4。"""
+    try:
+        addr = ipaddress.ip_address((raw or "").strip("[]"))
+    except ValueError:
+        return None
+    return str(getattr(addr, "ipv4_mapped", None) or addr)
+
+
+class DevtoolsRemoteTracker:
+    """分流用：收集 Network.responseReceived 里的远端 IP / 域名，新 IP 立刻加进会话 sink 的归属集合。"""
+
+    def __init__(self, sink: "CaptureSink"):
+        self.sink = sink
+        self.ips: Set[str] = set()
+        self.hosts: Set[str] = set()
+
+    def on_event(self, method: str, params: dict) -> None:
+        if method != "Network.responseReceived":
+            return
+        resp = params.get("response") or {}
+        host = urlparse(resp.get("url") or "").hostname
+        if host:
+            self.hosts.add(host)
+        ip = _devtools_ip(resp.get("remoteIPAddress"))
+        if ip and ip not in self.ips:
+            self.ips.add(ip)
+            self.sink.add_ips({ip})
+
+
+# 平台自己的域名 / 路径规则，先于通用规则匹配（匹配对象是 "域名/路径"）
+FLOW_LABEL_HINTS = (
+    ("danmaku", re.compile(r"(danmuproxy|wsproxy)\.douyu\.com", re.I)),
+    ("telemetry", re.compile(r"dotcounter\.douyu\.com|dot\.douyu\.com|/lapi/dot/", re.I)),
+    ("stream", re.compile(r"\.xs$", re.I)),    # 斗鱼 P2P 播放器拉的 FLV 流
+)
+
+# 一个 (IP, 端口, 域名) 上有多种请求时，取排在前面的类型
+FLOW_LABEL_ORDER = ("stream", "media_segment", "danmaku", "webrtc_signaling", "ads", "telemetry",
+                    "api", "static", "document", "other")
+_STREAM_PATH_RE = re.compile(r"\.(flv|m3u8|mpd)$", re.I)
+_SEGMENT_PATH_RE = re.compile(r"\.(ts|m4s|m4v|m4a|mp4|aac|cmfv|cmfa)$", re.I)
+_STREAM_MIMES = ("video/x-flv", "application/vnd.apple.mpegurl", "application/x-mpegurl", "application/dash+xml")
+_ADS_RE = re.compile(r"doubleclick|googlesyndication|adservice|(^|[./-])(ad|ads|adx|adv)[./-]", re.I)
+_TELEMETRY_RE = re.compile(r"google-analytics|googletagmanager|hm\.baidu\.com|sentry"
+                           r"|(^|[./-])(log|logs|report|track|tracker|beacon|stat|stats|monitor|metrics|collect)([./-]|$)",
+                           re.I)
+
+
+def classify_request(url: str, rtype: Optional[str] = None, mime: Optional[str] = None) -> str:
+    """按 URL / DevTools 资源类型 / MIME 给一个请求定类型（FLOW_LABEL_ORDER 之一）。"""
+    u = urlparse(url)
+    target = f"{u.hostname or ''}{u.path}"
+    for label, rx in FLOW_LABEL_HINTS:
+        if rx.search(target):
+            return label
+    mime = (mime or "").lower()
+    if rtype == "WebSocket" or u.scheme in ("ws", "wss"):
+        return "webrtc_signaling" if re.search(r"p2p|rtc|pcdn", target, re.I) else "danmaku"
+    if _STREAM_PATH_RE.search(u.path) or mime in _STREAM_MIMES:
+        return "stream"
+    if _SEGMENT_PATH_RE.search(u.path) or mime.startswith(("video/", "audio/")) or rtype == "Media":
+        return "media_segment"
+    if _ADS_RE.search(target):
+        return "ads"
+    if _TELEMETRY_RE.search(target) or rtype in ("Ping", "CSPViolationReport"):
+        return "telemetry"
+    if rtype in ("XHR", "Fetch", "EventSource"):
+        return "api"
+    if rtype in ("Script", "Stylesheet", "Image", "Font", "Manifest", "TextTrack"):
+        return "static"
+    if rtype == "Document":
+        return "document"
+    return "other"
+
+
+class FlowLabeler:
+    """
+    流标注：按 requestId 记下 URL / 资源类型 / MIME / 远端地址 / 字节数，结束时归并成 (IP, 端口, 域名) → 类型。
+    websocket 的事件里没有远端 IP，只按域名（即 SNI）给类型。WebRTC 的媒体走 ICE/UDP，不出现在 Network 事件里。
+    """
+
+    def __init__(self):
+        self._req: Dict[str, dict] = {}
+
+    def on_event(self, method: str, params: dict) -> None:
+        rid = params.get("requestId")
+        if not rid:
+            return
+        if method == "Network.requestWillBeSent":
+            r = self._req.setdefault(rid, {})
+            r["url"] = (params.get("request") or {}).get("url")
+            r["type"] = params.get("type")
+        elif method == "Network.responseReceived":
+            resp = params.get("response") or {}
+            r = self._req.setdefault(rid, {})
+            r["url"] = resp.get("url") or r.get("url")
+            r["type"] = params.get("type") or r.get("type")
+            r["mime"] = resp.get("mimeType")
+            r["ip"] = _devtools_ip(resp.get("remoteIPAddress"))
+            r["port"] = resp.get("remotePort")
+            r["protocol"] = resp.get("protocol")
+        elif method == "Network.webSocketCreated":
+            self._req.setdefault(rid, {}).update(url=params.get("url"), type="WebSocket")
+        elif method == "Network.dataReceived":
+            r = self._req.get(rid)
+            if r is not None:
+                r["bytes"] = r.get("bytes", 0) + int(params.get("encodedDataLength") or 0)
+        elif method == "Network.loadingFinished":
+            r = self._req.get(rid)
+            if r is not None:
+                r["bytes"] = max(r.get("bytes", 0), int(params.get("encodedDataLength") or 0))
+        elif method == "Network.webSocketFrameReceived":
+            r = self._req.get(rid)
+            if r is not None:
+                r["bytes"] = r.get("bytes", 0) + len((params.get("response") or {}).get("payloadData") or "")
+
+    def summary(self) -> dict:
+        """flows：每个 (IP, 端口, 域名) 一条；endpoints：IP:端口 → 类型，下游过滤直接查这个。"""
+        flows: Dict[Tuple, dict] = {}
+        for r in self._req.values():
+            url = r.get("url") or ""
+            host = urlparse(url).hostname
+            if not host:
+                continue    # data: / blob:
+            label = classify_request(url, r.get("type"), r.get("mime"))
+            f = flows.setdefault((r.get("ip"), r.get("port"), host), {
+                "ip": r.get("ip"), "port": r.get("port"), "host": host,
+                "label": label, "protocol": r.get("protocol"), "requests": 0, "bytes": 0,
+            })
+            f["requests"] += 1
+            f["bytes"] += r.get("bytes", 0)
+            if FLOW_LABEL_ORDER.index(label) < FLOW_LABEL_ORDER.index(f["label"]):
+                f["label"] = label
+            f["protocol"] = f["protocol"] or r.get("protocol")
+
+        endpoints: Dict[str, str] = {}
+        for f in flows.values():
+            if not f["ip"] or not f["port"]:
+                continue
+            ep = f"[{f['ip']}]:{f['port']}" if ":" in f["ip"] else f"{f['ip']}:{f['port']}"
+            old = endpoints.get(ep)
+            if old is None or FLOW_LABEL_ORDER.index(f["label"]) < FLOW_LABEL_ORDER.index(old):
+                endpoints[ep] = f["label"]
+        return {
+            "platform": PLATFORM,
+            "endpoints": endpoints,
+            "hosts": {f["host"]: f["label"] for f in sorted(flows.values(), key=lambda f: -f["bytes"])},
+            "flows": sorted(flows.values(), key=lambda f: -f["bytes"]),
+        }
+
+
+# 媒体时间线的列（parquet schema / csv 表头）
+TIMELINE_COLUMNS = (
+    ("request_id", "str"), ("kind", "str"), ("url_pattern", "str"), ("segment", "str"), ("host", "str"),
+    ("remote_ip", "str"), ("remote_port", "int"), ("mime", "str"), ("status", "int"),
+    ("request_ts", "float"), ("response_ts", "float"), ("finished_ts", "float"), ("offset_s", "float"),
+    ("bytes", "int"), ("body_bytes", "int"), ("duration_s", "float"), ("bitrate_kbps", "float"),
+    ("outcome", "str"),
+)
+TIMELINE_BATCH_ROWS = 64
+
+
+class TimelineWriter:
+    """
+    媒体时间线落盘：parquet 每攒 TIMELINE_BATCH_ROWS 行写一个 row group，csv 每行 flush；
+    内存里最多压一批，不随会话时长增长。没装 pyarrow 时退回 csv。
+    """
+
+    def __init__(self, base: str, fmt: str = "parquet"):
+        self.rows = 0
+        self._lock = threading.Lock()
+        self._batch: List[dict] = []
+        self._pq = None
+        self._csv = None
+        if fmt == "parquet":
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                print("⚠️ 没装 pyarrow，媒体时间线改写 csv")
+                fmt = "csv"
+        self.format = fmt
+        self.path = f"{base}.media.{fmt}"
+        if fmt == "parquet":
+            types = {"str": pa.string(), "int": pa.int64(), "float": pa.float64()}
+            self._pa = pa
+            self._schema = pa.schema([(n, types[t]) for n, t in TIMELINE_COLUMNS])
+            self._pq = pq.ParquetWriter(self.path, self._schema, compression="zstd")
+        else:
+            self._file = open(self.path, "w", encoding="utf-8", newline="")
+            self._csv = csv.DictWriter(self._file, fieldnames=[n for n, _ in TIMELINE_COLUMNS])
+            self._csv.writeheader()
+
+    def write(self, row: dict) -> None:
+        with self._lock:
+            if self._csv is not None:
+                self._csv.writerow(row)
+                self._file.flush()
+            elif self._pq is not None:
+                self._batch.append(row)
+                if len(self._batch) >= TIMELINE_BATCH_ROWS:
+                    self._flush()
+            else:
+                return    # 已关闭
+            self.rows += 1
+
+    def _flush(self) -> None:
+        if self._batch:
+            self._pq.write_table(self._pa.Table.from_pylist(self._batch, schema=self._schema))
+            self._batch = []
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pq is not None:
+                self._flush()
+                self._pq.close()
+                self._pq = None
+            if self._csv is not None:
+                self._file.close()
+                self._csv = None
+
+    def move(self, base: str) -> None:
+        """pcap 改名后跟着改名。"""
+        path = f"{base}.media.{self.format}"
+        if path == self.path:
+            return
+        try:
+            os.replace(self.path, path)
+            self.path = path
+        except OSError as e:
+            print(f"⚠️ 媒体时间线改名失败，保留: {self.path}，原因: {e}")
+
+
+class MediaTimelineRecorder:
+    """
+    媒体时间线：每个媒体响应（直播流 / 分片）结束时写一行，只有进行中的请求留在内存里。
+    DevTools 的 timestamp 是单调时钟，用 requestWillBeSent 的 wallTime 换成 epoch 秒，和 pcap 的包时间同一个时钟。
+    分片码率 = 正文字节 / 和上一个同模式分片的请求间隔（直播播放器稳态下每个分片时长拉一次）；
+    FLV 这类长连接流 = 正文字节 / 收数据的时长。
+    """
+
+    def __init__(self, writer: TimelineWriter, origin: Optional[float]):
+        self.writer = writer
+        self.origin = origin
+        self._clock: Optional[float] = None    # wallTime - timestamp
+        self._req: Dict[str, dict] = {}
+        self._last_request: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _wall(self, ts) -> Optional[float]:
+        if ts is None or self._clock is None:
+            return None
+        return round(ts + self._clock, 6)
+
+    def on_event(self, method: str, params: dict) -> None:
+        with self._lock:
+            if not self._closed:
+                self._on_event(method, params)
+
+    def _on_event(self, method: str, params: dict) -> None:
+        rid = params.get("requestId")
+        if not rid:
+            return
+        if method == "Network.requestWillBeSent":
+            if params.get("wallTime") and params.get("timestamp"):
+                self._clock = params["wallTime"] - params["timestamp"]
+            self._req[rid] = {
+                "url": (params.get("request") or {}).get("url") or "", "type": params.get("type"),
+                "request": params.get("timestamp"), "bytes": 0, "body": 0,
+            }
+        elif method == "Network.responseReceived":
+            r = self._req.get(rid)
+            if r is None:
+                return
+            resp = params.get("response") or {}
+            url = resp.get("url") or r["url"]
+            kind = classify_request(url, params.get("type") or r["type"], resp.get("mimeType"))
+            if kind not in ("stream", "media_segment"):
+                del self._req[rid]
+                return
+            r.update(kind=kind, url=url, mime=resp.get("mimeType"), status=resp.get("status"),
+                     ip=_devtools_ip(resp.get("remoteIPAddress")), port=resp.get("remotePort"),
+                     response=params.get("timestamp"))
+        elif method == "Network.dataReceived":
+            r = self._req.get(rid)
+            if r is not None and "kind" in r:
+                r["body"] += int(params.get("dataLength") or 0)
+                r["bytes"] += int(params.get("encodedDataLength") or 0)
+                r["last"] = params.get("timestamp")
+        elif method in ("Network.loadingFinished", "Network.loadingFailed"):
+            r = self._req.pop(rid, None)
+            if r is None or "kind" not in r:
+                return
+            if method == "Network.loadingFinished":
+                r["bytes"] = max(r["bytes"], int(params.get("encodedDataLength") or 0))
+                self._emit(rid, r, params.get("timestamp"), "finished")
+            else:
+                self._emit(rid, r, params.get("timestamp"), "failed")
+
+    def close(self) -> int:
+        """
+        DevTools 读者停下（轮询线程已 join）之后调用：还开着的流（FLV 长连接）按已收到的数据写一行，然后关文件。
+        之后再来的事件直接丢弃，不会写进已关闭的文件。
+        """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                for rid, r in self._req.items():
+                    if "kind" in r:
+                        self._emit(rid, r, r.get("last"), "open")
+                self._req.clear()
+                self.writer.close()
+        return self.writer.rows
+
+    def _emit(self, rid: str, r: dict, end, outcome: str) -> None:
+        u = urlparse(r["url"])
+        pattern = re.sub(r"(?<![A-Za-z])\d+", "{n}", f"{u.hostname or ''}{u.path}")    # 序号 / 时间戳 → {n}，m4s / mp4 不动
+        request_ts, response_ts, finished_ts = self._wall(r["request"]), self._wall(r.get("response")), self._wall(end)
+
+        duration = None
+        if r["kind"] == "media_segment":
+            prev = self._last_request.get(pattern)
+            if prev is not None and request_ts is not None and 0 < request_ts - prev <= 30:
+                duration = request_ts - prev
+            if request_ts is not None:
+                self._last_request[pattern] = request_ts
+        elif not u.path.lower().endswith((".m3u8", ".mpd")) and response_ts and finished_ts and finished_ts > response_ts:
+            duration = finished_ts - response_ts
+
+        self.writer.write({
+            "request_id": rid,
+            "kind": r["kind"],
+            "url_pattern": pattern,
+            "segment": u.path.rsplit("/", 1)[-1],
+            "host": u.hostname,
+            "remote_ip": r.get("ip"),
+            "remote_port": r.get("port"),
+            "mime": r.get("mime"),
+            "status": r.get("status"),
+            "request_ts": request_ts,
+            "response_ts": response_ts,
+            "finished_ts": finished_ts,
+            "offset_s": round(request_ts - self.origin, 6) if request_ts is not None and self.origin else None,
+            "bytes": r["bytes"],
+            "body_bytes": r["body"],
+            "duration_s": round(duration, 3) if duration else None,
+            "bitrate_kbps": round(r["body"] * 8 / duration / 1000, 1) if duration else None,
+            "outcome": outcome,
+        })
+
+
+def filter_pcap_by_flows(path: str, tracker: ProcessFlowTracker) -> Tuple[int, int]:
+    """
+    按进程流表重写 pcap / pcapng：只留属于这棵进程树的包，非包块（SHB / IDB / 统计）原样保留。
+    返回 (保留包数, 总包数)；文件读不动时不改原文件。
+    """
+    tmp = path + ".flows.tmp"
+    kept = total = 0
+    with open(path, "rb") as src, open(tmp, "wb", buffering=1 << 20) as out:
+        magic = src.read(4)
+        src.seek(0)
+        if magic == b"\x0a\x0d\x0d\x0a":
+            order, linktypes = "little", []
+            while True:
+                head = src.read(12)
+                if len(head) < 12:
+                    break
+                if head[:4] == b"\x0a\x0d\x0d\x0a":
+                    order = "little" if head[8:12] == b"\x4d\x3c\x2b\x1a" else "big"
+                    linktypes = []
+                btype = int.from_bytes(head[:4], order)
+                blen = int.from_bytes(head[4:8], order)
+                body = head + src.read(max(0, blen - 12))
+                if len(body) < blen or blen < 12:
+                    break                       # 尾部截断的块丢掉
+                if btype == 1:
+                    linktypes.append(int.from_bytes(body[8:10], order))
+                elif btype in (3, 6):
+                    if btype == 6:
+                        iface = int.from_bytes(body[8:12], order)
+                        data = body[28:28 + int.from_bytes(body[20:24], order)]
+                    else:
+                        iface = 0
+                        data = body[12:12 + min(int.from_bytes(body[8:12], order), blen - 16)]
+                    total += 1
+                    five = packet_five_tuple(linktypes[iface] if iface < len(linktypes) else 1, data)
+                    if not (five and tracker.owns(five)):
+                        continue
+                    kept += 1
+                out.write(body)
+        else:
+            header = src.read(24)
+            if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+                order = "little"
+            elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+                order = "big"
+            else:
+                out.close()
+                os.remove(tmp)
+                return 0, 0
+            linktype = int.from_bytes(header[20:24], order) & 0x0FFFFFFF
+            out.write(header)
+            while True:
+                rec = src.read(16)
+                if len(rec) < 16:
+                    break
+                data = src.read(int.from_bytes(rec[8:12], order))
+                if len(data) < int.from_bytes(rec[8:12], order):
+                    break
+                total += 1
+                five = packet_five_tuple(linktype, data)
+                if five and tracker.owns(five):
+                    kept += 1
+                    out.write(rec + data)
+    os.replace(tmp, path)
+    return kept, total
+
+
+# ----------------------------
+# 常驻抓包：dumpcap 只启动一次（-w - 把经典 pcap 流写到 stdout），读线程逐条解析记录，
+# 按包时间戳分发到各会话的输出文件（sink）。会话切换不再启动进程，房间之间也不丢包
+# ----------------------------
+SINK_DRAIN_SECONDS = 1.0     # 停止后等管道里时间戳早于停止时刻的包最多这么久
+
+
+class CaptureSink:
+    """一个会话的输出文件：只收时间戳落在 [started_at, stop_at) 里的包；文件头照抄抓包流的全局头。"""
+
+    def __init__(self, path: str, header: bytes):
+        self.path = path
+        self.started_at = time.time()
+        self.stop_at: Optional[float] = None
+        self.packets = 0
+        self.drops: Optional[int] = None    # 窗口内内核丢包数（读不到的后端保持 None）
+        self.ips: Optional[Set[str]] = None  # 分流模式：这个会话连过的远端 IP（None = 收整张网卡）
+        self.finalizer = None                # 分流模式：收尾交给引擎，和分流写入串行
+        self.claimer = None                  # 分流模式：新 IP 交给引擎加，顺带认领引擎里压着的包
+        self.drain_until: Optional[float] = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._f = open(path, "wb")
+        self._f.write(header)
+        self._f.flush()
+
+    def feed(self, ts: float, record: bytes) -> None:
+        with self._lock:
+            if self._done.is_set():
+                return
+            if self.stop_at is not None and ts >= self.stop_at:
+                self._finish()    # 已经看到停止时刻之后的包：前面的都到齐了
+                return
+            if ts >= self.started_at:
+                self._f.write(record)
+                self.packets += 1
+
+    def add_ips(self, ips: Set[str]) -> None:
+        if self.claimer is not None:
+            self.claimer(self, ips)
+        else:
+            self.learn(ips)
+
+    def learn(self, ips: Set[str]) -> Set[str]:
+        """加进归属集合，返回之前没有的那些 IP。"""
+        with self._lock:
+            new = ips - (self.ips or set())
+            self.ips = (self.ips or set()) | ips
+            return new
+
+    def wants(self, ts: float, ips: Optional[Tuple[int, str, str, Optional[int]]]) -> bool:
+        with self._lock:
+            if ips is None or not self.ips or ts < self.started_at:
+                return False
+            if self.stop_at is not None and ts >= self.stop_at:
+                return False
+            return ips[1] in self.ips or ips[2] in self.ips
+
+    def write(self, record: bytes) -> None:
+        with self._lock:
+            if not self._done.is_set():
+                self._f.write(record)
+                self.packets += 1
+
+    def finish(self) -> None:
+        with self._lock:
+            if not self._done.is_set():
+                self._finish()
+
+    def _finish(self) -> None:
+        self._f.flush()
+        try:
+            os.fsync(self._f.fileno())
+        except OSError:
+            pass
+        self._f.close()
+        self._done.set()
+
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    def close(self, stop_at: float, drain: float = SINK_DRAIN_SECONDS) -> str:
+        """返回 "switch"（看到了边界之后的包）或 "drain"（等满 drain 秒，网卡空闲）。"""
+        with self._lock:
+            self.stop_at = stop_at
+            self.drain_until = time.time() + drain
+        if self._done.wait(drain):
+            return "switch"
+        if self.finalizer is not None:
+            self.finalizer(self)
+        else:
+            self.finish()
+        return "drain"
+
+
+class SinkFanout:
+    """
+    常驻抓包引擎的公共部分：按包时间戳把记录分发给当前打开的各个 sink（多个会话共用一路抓包）。
+    demux_hold > 0 时是分流模式：远端 IP 已经归属某个会话的包当场写进去（同一 IP 归属多个会话时每个都写）；
+    没人认领的包压在内存里，最多 demux_hold 秒、共 demux_hold_bytes 字节，哪个会话随后学到这个 IP 就当场取走，
+    过期 / 超额时从最旧的丢起。后台定时器按墙钟清过期的包、给超时没收尾的 sink 收尾，网卡空闲时也不拖。
+    补写进来的包比同一文件里其它流的包写得晚，所以文件里的时间戳只在同一条流内保证递增。
+    """
+
+    REAP_INTERVAL = 0.5
+
+    def __init__(self, demux_hold: float = 0.0, demux_hold_bytes: int = 0):
+        self.header = b""
+        self.linktype = 1
+        self.demux_hold = demux_hold
+        self.demux_hold_bytes = demux_hold_bytes
+        self.unclaimed = 0
+        self._sinks: List[CaptureSink] = []
+        self._lock = threading.Lock()
+        # (时间戳, 记录, packet_ips, 已经取走它的 sink)
+        self._held: "deque[Tuple[float, bytes, Tuple[int, str, str, Optional[int]], List[CaptureSink]]]" = deque()
+        self._held_bytes = 0
+        self._held_lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+        self._reaper_stop = threading.Event()
+
+    def open_sink(self, path: str) -> CaptureSink:
+        sink = CaptureSink(path, self.header)
+        if self.demux_hold:
+            sink.ips = set()
+            sink.finalizer = self._finalize
+            sink.claimer = self._claim
+        with self._lock:
+            self._sinks.append(sink)
+            if self.demux_hold and self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap_loop, name="demux-reaper", daemon=True)
+                self._reaper.start()
+        return sink
+
+    def _open_sinks(self) -> List[CaptureSink]:
+        with self._lock:
+            self._sinks = [s for s in self._sinks if not s.finished()]
+            return list(self._sinks)
+
+    def _dispatch(self, ts: float, record: bytes) -> None:
+        sinks = self._open_sinks()
+        if not self.demux_hold:
+            for s in sinks:
+                s.feed(ts, record)
+            return
+
+        ips = packet_ips(self.linktype, record[16:])
+        with self._held_lock:
+            owners = [s for s in sinks if s.wants(ts, ips)]
+            for s in owners:
+                s.write(record)
+            if not owners:
+                if ips is None:
+                    self.unclaimed += 1    # 不是 IP 包，不会有人认领
+                else:
+                    self._held.append((ts, record, ips, []))
+                    self._held_bytes += len(record)
+            self._expire(ts)
+        # 看到停止时刻之后的包：这个会话的包都到齐了（停止前已经收完最后一次 DevTools 日志）
+        for s in sinks:
+            if s.stop_at is not None and ts >= s.stop_at:
+                self._finalize(s)
+
+    def _claim(self, sink: CaptureSink, ips: Set[str]) -> None:
+        """会话学到新 IP：在分流锁里加进归属集合，压着的包里属于这些 IP 的立刻补写，之后的包当场写，同一条流不乱序。"""
+        with self._held_lock:
+            new = sink.learn(ips)
+            if not new:
+                return
+            for ts, rec, pips, claimed in self._held:
+                if (pips[1] in new or pips[2] in new) and sink not in claimed and sink.wants(ts, pips):
+                    sink.write(rec)
+                    claimed.append(sink)
+
+    def _expire(self, now: float) -> None:
+        cutoff = now - self.demux_hold
+        while self._held and (self._held[0][0] < cutoff
+                              or (self.demux_hold_bytes and self._held_bytes > self.demux_hold_bytes)):
+            _, rec, _, claimed = self._held.popleft()
+            self._held_bytes -= len(rec)
+            if not claimed:
+                self.unclaimed += 1
+
+    def _reap_loop(self) -> None:
+        while not self._reaper_stop.wait(self.REAP_INTERVAL):
+            now = time.time()
+            with self._held_lock:
+                self._expire(now)
+            # close() 自己等满 drain 就会收尾；这里兜底它没能收尾的 sink
+            for s in self._open_sinks():
+                if s.drain_until is not None and now >= s.drain_until + self.REAP_INTERVAL:
+                    self._finalize(s)
+
+    def _finalize(self, sink: CaptureSink) -> None:
+        with self._held_lock:
+            sink.finish()
+
+    def _close_sinks(self) -> None:
+        # 抓包停了：还开着的 sink 按现有内容收尾
+        self._reaper_stop.set()
+        with self._lock:
+            sinks, self._sinks = self._sinks, []
+        for s in sinks:
+            s.close(time.time(), drain=0)
+
+
+class DumpcapDaemon(SinkFanout):
+    """
+    dumpcap -P -w - 输出经典 pcap（24 字节全局头 + 16 字节记录头 + 数据）；
+    多个并发会话各自一个 sink，都收到整张网卡的包（和以前每个会话一个 tshark 一样）。
+    """
+
+    def __init__(self, dumpcap_path: str, iface: str, snaplen: int = 0, bpf: Optional[str] = None,
+                 demux_hold: float = 0.0, demux_hold_bytes: int = 0):
+        super().__init__(demux_hold, demux_hold_bytes)
+        self.cmd = [dumpcap_path, "-q", "-i", iface, "-P", "-w", "-"]
+        if bpf:
+            self.cmd += ["-f", bpf]
+        if snaplen:
+            self.cmd += ["-s", str(snaplen)]
+        self.proc: Optional[subprocess.Popen] = None
+        self._order = "little"
+        self._nanos = False
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, timeout: float) -> None:
+        kwargs = {}
+        if os.name == "nt":
+            kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        self.proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                     bufsize=0, **kwargs)
+        self._thread = threading.Thread(target=self._pump, name="dumpcap-pump", daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            self.shutdown()
+            raise RuntimeError(f"dumpcap {timeout:.0f}s 内没有输出 pcap 头，检查网卡名 / 抓包权限")
+        print(f"📡 常驻 dumpcap 已启动 (pid={self.proc.pid})")
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None and self._ready.is_set()
+
+    def _read_exact(self, n: int) -> Optional[bytes]:
+        buf = b""
+        while len(buf) < n:
+            chunk = self.proc.stdout.read(n - len(buf))
+            if not chunk:
+                return None
+            buf += chunk
+        return buf
+
+    def _pump(self) -> None:
+        try:
+            header = self._read_exact(24)
+            if header is None:
+                return
+            magic = header[:4]
+            if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+                self._order = "little"
+            elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+                self._order = "big"
+            else:
+                print(f"⚠️ dumpcap 输出不是经典 pcap（magic={magic.hex()}），停止读取")
+                return
+            self._nanos = magic in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d")
+            self.header = header
+            self.linktype = int.from_bytes(header[20:24], self._order) & 0x0FFFFFFF
+            self._ready.set()
+
+            order, div = self._order, (1e9 if self._nanos else 1e6)
+            while True:
+                rec = self._read_exact(16)
+                if rec is None:
+                    break
+                data = self._read_exact(int.from_bytes(rec[8:12], order))
+                if data is None:
+                    break
+                ts = int.from_bytes(rec[0:4], order) + int.from_bytes(rec[4:8], order) / div
+                self._dispatch(ts, rec + data)
+        finally:
+            self._close_sinks()
+
+    def shutdown(self) -> None:
+        proc = self.proc
+        if proc is None or proc.poll() is not None:
+            return
+        try:
+            proc.send_signal(signal.CTRL_BREAK_EVENT if os.name == "nt" else signal.SIGINT)
+            proc.wait(timeout=5)
+        except Exception:
+            proc.kill()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+
+# ----------------------------
+# Linux 进程内抓包：AF_PACKET + TPACKET_V3 内存映射环形缓冲（不起子进程，内核丢包计数直接读）
+# ----------------------------
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+ETH_P_ALL = 0x0003
+SO_ATTACH_FILTER = 26
+PACKET_OUTGOING = 4
+ARPHRD_TO_LINKTYPE = {1: 1, 772: 1, 65534: 101}   # 以太网 / 回环 → EN10MB，tun 之类 → RAW
+
+
+def compile_bpf(expr: str, snaplen: int, linktype: int = 1) -> List[Tuple[int, int, int, int]]:
+    """用 libpcap 的 pcap_compile 把 tcpdump 语法编译成经典 BPF 指令 (code, jt, jf, k)。"""
+    path = ctypes.util.find_library("pcap")
+    if not path:
+        raise RuntimeError("编译 BPF 过滤表达式需要 libpcap（如 apt install libpcap0.8）")
+    lib = ctypes.CDLL(path)
+
+    class BpfInsn(ctypes.Structure):
+        _fields_ = [("code", ctypes.c_ushort), ("jt", ctypes.c_ubyte), ("jf", ctypes.c_ubyte), ("k", ctypes.c_uint)]
+
+    class BpfProgram(ctypes.Structure):
+        _fields_ = [("bf_len", ctypes.c_uint), ("bf_insns", ctypes.POINTER(BpfInsn))]
+
+    lib.pcap_open_dead.restype = ctypes.c_void_p
+    lib.pcap_open_dead.argtypes = [ctypes.c_int, ctypes.c_int]
+    lib.pcap_compile.argtypes = [ctypes.c_void_p, ctypes.POINTER(BpfProgram), ctypes.c_char_p,
+                                 ctypes.c_int, ctypes.c_uint]
+    lib.pcap_geterr.restype = ctypes.c_char_p
+    lib.pcap_geterr.argtypes = [ctypes.c_void_p]
+    lib.pcap_freecode.argtypes = [ctypes.POINTER(BpfProgram)]
+    lib.pcap_close.argtypes = [ctypes.c_void_p]
+
+    handle = lib.pcap_open_dead(linktype, snaplen)
+    prog = BpfProgram()
+    try:
+        if lib.pcap_compile(handle, ctypes.byref(prog), expr.encode(), 1, 0xFFFFFFFF) != 0:
+            raise ValueError(f"BPF 过滤表达式无效: {expr}: {lib.pcap_geterr(handle).decode(errors='replace')}")
+        insns = [(i.code, i.jt, i.jf, i.k) for i in prog.bf_insns[:prog.bf_len]]
+        lib.pcap_freecode(ctypes.byref(prog))
+        return insns
+    finally:
+        lib.pcap_close(handle)
+
+
+class AfPacketEngine(SinkFanout):
+    """
+    一个网卡一个 TPACKET_V3 环：内核按块（block）填包，读线程逐块取出写进各 sink，再把块还给内核。
+    块超时 60ms 就提前交给用户态，网卡空闲时停止边界也不会拖太久。
+    """
+
+    BLOCK_SIZE = 1 << 20
+    FRAME_SIZE = 1 << 11
+    BLOCK_TIMEOUT_MS = 60
+
+    def __init__(self, iface: str, snaplen: int = 0, bpf: Optional[str] = None, ring_mb: int = 64,
+                 demux_hold: float = 0.0, demux_hold_bytes: int = 0):
+        super().__init__(demux_hold, demux_hold_bytes)
+        self.iface = iface
+        self.snaplen = snaplen if snaplen > 0 else 262144
+        self.bpf = bpf
+        self.block_nr = max(4, ring_mb * (1 << 20) // self.BLOCK_SIZE)
+        self.drops = 0
+        self.kernel_packets = 0
+        self._sock: Optional[socket.socket] = None
+        self._ring: Optional[mmap.mmap] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _arphrd(self) -> int:
+        try:
+            with open(f"/sys/class/net/{self.iface}/type", "r") as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return 1
+
+    def start(self, timeout: float) -> None:
+        if not hasattr(socket, "AF_PACKET"):
+            raise RuntimeError("capture_backend=\"afpacket\" 只支持 Linux")
+        arphrd = self._arphrd()
+        linktype = self.linktype = ARPHRD_TO_LINKTYPE.get(arphrd, 1)
+        self._skip_outgoing = arphrd == 772   # 回环上每个包会以 OUTGOING + HOST 各出现一次，和 libpcap 一样丢掉前者
+
+        # protocol=0 创建：bind 之前收不到包，过滤器和环都配好再开始收
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        try:
+            sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            if self.bpf:
+                insns = compile_bpf(self.bpf, self.snaplen, linktype)
+                code = ctypes.create_string_buffer(b"".join(struct.pack("=HBBI", *i) for i in insns))
+                sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                                struct.pack("@HP", len(insns), ctypes.addressof(code)))
+            frame_nr = self.BLOCK_SIZE * self.block_nr // self.FRAME_SIZE
+            sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack(
+                "=IIIIIII", self.BLOCK_SIZE, self.block_nr, self.FRAME_SIZE, frame_nr,
+                self.BLOCK_TIMEOUT_MS, 0, 0))
+            self._ring = mmap.mmap(sock.fileno(), self.BLOCK_SIZE * self.block_nr,
+                                   mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            sock.bind((self.iface, ETH_P_ALL))
+        except Exception:
+            sock.close()
+            raise
+        self._sock = sock
+        self.header = struct.pack("=IHHiIII", 0xA1B23C4D, 2, 4, 0, 0, self.snaplen, linktype)
+        self._read_stats()    # 清掉 bind 之前的计数
+        self.drops = self.kernel_packets = 0
+
+        self._thread = threading.Thread(target=self._pump, name="afpacket-pump", daemon=True)
+        self._thread.start()
+        print(f"📡 AF_PACKET 抓包已启动: {self.iface}（环 {self.block_nr} MB"
+              f"{'，过滤 ' + self.bpf if self.bpf else ''}）")
+
+    def alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def open_sink(self, path: str) -> CaptureSink:
+        sink = super().open_sink(path)
+        sink.drops = 0
+        return sink
+
+    def _read_stats(self) -> None:
+        """PACKET_STATISTICS 读一次清零一次：把这段时间的丢包加到引擎和每个开着的 sink 上。"""
+        try:
+            packets, drops, _ = struct.unpack("=III", self._sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))
+        except OSError:
+            return
+        self.kernel_packets += packets
+        self.drops += drops
+        if drops:
+            for s in self._open_sinks():
+                s.drops = (s.drops or 0) + drops
+
+    def _pump(self) -> None:
+        ring, bs = self._ring, self.BLOCK_SIZE
+        poller = select.poll()
+        poller.register(self._sock.fileno(), select.POLLIN | select.POLLERR)
+        idx = 0
+        try:
+            while not self._stop.is_set():
+                base = idx * bs
+                status = struct.unpack_from("=I", ring, base + 8)[0]
+                if not status & TP_STATUS_USER:
+                    poller.poll(200)
+                    self._read_stats()
+                    continue
+                num_pkts, first = struct.unpack_from("=II", ring, base + 12)
+                p = base + first
+                for _ in range(num_pkts):
+                    next_off, sec, nsec, caplen, wirelen = struct.unpack_from("=IIIII", ring, p)
+                    mac = struct.unpack_from("=H", ring, p + 24)[0]
+                    # tpacket3_hdr 之后（对齐到 48 字节）是 sockaddr_ll，pkttype 在其第 10 字节
+                    if not (self._skip_outgoing and ring[p + 48 + 10] == PACKET_OUTGOING):
+                        caplen = min(caplen, self.snaplen)
+                        self._dispatch(sec + nsec / 1e9,
+                                       struct.pack("=IIII", sec, nsec, caplen, wirelen) + ring[p + mac:p + mac + caplen])
+                    p += next_off
+                struct.pack_into("=I", ring, base + 8, TP_STATUS_KERNEL)
+                idx = (idx + 1) % self.block_nr
+                self._read_stats()
+        finally:
+            self._close_sinks()
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        if self._ring is not None:
+            try:
+                self._ring.close()
+            except Exception:
+                pass
+        if self._sock is not None:
+            self._sock.close()
+
+
+_CAPTURE_DAEMONS: Dict[Tuple, Union[DumpcapDaemon, AfPacketEngine]] = {}
+_CAPTURE_DAEMON_LOCK = threading.Lock()
+
+
+def capture_daemon(cfg: RunConfig) -> Union[DumpcapDaemon, AfPacketEngine]:
+    """
+    每张网卡一个常驻抓包引擎（dumpcap / AF_PACKET；多个 worker、多轮 main() 都复用）；挂了就重启。
+    后端 / 过滤表达式 / 截断长度 / 分流参数不同的配置各用各的引擎，不会拿到按别的配置抓的包。
+    """
+    hold = cfg.capture_demux_hold if cfg.capture_demux == "devtools" else 0.0
+    hold_bytes = cfg.capture_demux_hold_mb << 20 if hold else 0
+    key = (cfg.network_iface, cfg.capture_backend, cfg.capture_filter, cfg.capture_snaplen, hold, hold_bytes)
+    with _CAPTURE_DAEMON_LOCK:
+        d = _CAPTURE_DAEMONS.get(key)
+        if d is None or not d.alive():
+            if d is not None:
+                print("⚠️ 常驻抓包已退出，重新启动")
+            if cfg.capture_backend == "afpacket":
+                d = AfPacketEngine(cfg.network_iface, cfg.capture_snaplen, cfg.capture_filter, cfg.afpacket_ring_mb,
+                                   demux_hold=hold, demux_hold_bytes=hold_bytes)
+            else:
+                d = DumpcapDaemon(cfg.dumpcap_path, cfg.network_iface, cfg.capture_snaplen, cfg.capture_filter,
+                                  demux_hold=hold, demux_hold_bytes=hold_bytes)
+            d.start(cfg.capture_start_timeout)
+            atexit.register(d.shutdown)
+            _CAPTURE_DAEMONS[key] = d
+        return d
+
+
+# ----------------------------
+# 采集元数据：和 pcap 同名的 <pcap>.meta.json（房间 / 画质 / 画质阶梯等，数据集用）
+# ----------------------------
+def write_capture_meta(pcap_path: str, meta: dict) -> Optional[str]:
+    """与已有的 meta 合并后原子写入；失败只打印，不影响 pcap。"""
+    path = pcap_path + ".meta.json"
+    data = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f) or {}
+    except (OSError, ValueError):
+        pass
+    data.update(meta)
+    try:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+        return path
+    except OSError as e:
+        print(f"⚠️ 元数据写入失败: {path}，原因: {e}")
+        return None
+
+
+def write_flow_labels(pcap_path: str, labels: dict) -> Optional[str]:
+    """流标注原子写入 <pcap>.labels.json；失败只打印，不影响 pcap。"""
+    path = pcap_path + ".labels.json"
+    try:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(labels, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, path)
+        return path
+    except OSError as e:
+        print(f"⚠️ 流标注写入失败: {path}，原因: {e}")
+        return None
+
+
 # ----------------------------
 # ✅ 单直播间：每次“新开浏览器输入网址”，并复用登录态
 # ----------------------------
-def run_capture_session_douyu_restart_browser(cfg: RunConfig, category_name: str, room_url: str):
+def run_capture_session_douyu_restart_browser(cfg: RunConfig, category_name: str, room_url: str, worker_id: int = 0,
+                                              pool: Optional[WarmDriverPool] = None):
     os.makedirs(cfg.pcap_dir, exist_ok=True)
 
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     safe_cat = re.sub(r"[\\/:*?\"<>|]", "_", category_name or "unknown")
 
-    tmp_filename = f"{safe_cat}_pending_{timestamp}.pcap"
+    tmp_filename = f"{safe_cat}_pending_{timestamp}_w{worker_id}.pcap"
     tmp_filepath = os.path.join(cfg.pcap_dir, tmp_filename)
 
-    duration = cfg.dwell_seconds + cfg.tshark_extra_seconds
-    tshark_proc = None
+    # 并发时不同 worker 可能同一秒落盘同分类同画质，文件名带上 worker 编号
+    worker_suffix = f"_w{worker_id}" if cfg.max_concurrent_sessions > 1 else ""
+
+    capture = CaptureController(cfg, tmp_filepath)
     driver = None
     picked = None
+    ladder: List[dict] = []
+    autoplay_clicks = 0
+    autoplay_overlays = 0
+    abort_reason = None
+    playback: dict = {}
+    saved_path = None
 
-    user_data_dir = get_user_data_dir_from_arg(cfg.user_data_arg or "")
+    user_data_dir = shared_profile_dir(cfg)
 
     try:
-        # 1) 先启动 tshark
-        tshark_proc = start_tshark_capture(cfg, tmp_filepath, duration)
-        print(f"▶️ 开始抓包(临时): {tmp_filename}")
+        # 1) ✅ 启动新浏览器（复用登录态 profile）
+        driver = pool.acquire() if pool is not None else build_driver_with_retry(cfg)
 
-        # 2) ✅ 启动新浏览器（复用登录态 profile）
-        driver = build_driver_with_retry(cfg)
+        # 2) 浏览器就绪后才开始抓包（启动噪声不进 pcap）；确认 tshark 已在写文件再打开直播间
+        capture.start(driver)
+        print(f"▶️ 开始抓包(临时): {tmp_filename}")
 
         # 3) ✅ 输入直播间网址
         driver.get(room_url)
-        time.sleep(1.0)
 
-        # 4) autoplay 遮罩：看见就点
-        c = douyu_autoplay_guard(driver, seconds=8.0, interval=0.25)
-        if c:
-            print(f"▶️ autoplay遮罩鼠标点击次数: {c}")
+        # 4) autoplay 遮罩：页面内监听，只负责发现；点击一律用真实鼠标
+        install_douyu_autoplay_watcher(driver)
+
+        # 等播放器真正起播；没播起来时用真实鼠标点一次遮罩
+        ready = wait_player_ready(driver, cfg)
+        while not ready["ok"] and ready["stage"] is not None and autoplay_clicks < 3:
+            if not douyu_mouse_click_autoplay_if_present(driver):
+                break
+            autoplay_clicks += 1
+            ready = wait_player_ready(driver, cfg, stages=PLAYER_STAGES[1:])
 
         # 5) 选画质
         print("加载完开始选择画质(斗鱼)")
-        picked = select_quality_douyu_fast(driver, preferred=cfg.preferred_qualities)
+        quality = select_quality_douyu_fast(driver, preferred=cfg.preferred_qualities,
+                                            deadline=cfg.quality_select_deadline, stats=selector_stats(cfg))
+        picked, ladder = quality["picked"], quality["ladder"]
         print(f"🎚️ 画质选择结果: {picked}")
 
-        # 6) 停留：全程持续检查遮罩
+        # 6) 停留：播放结论里带回遮罩状态，遮罩出现时用真实鼠标点掉
+        def click_overlay() -> bool:
+            nonlocal autoplay_clicks
+            if not douyu_mouse_click_autoplay_if_present(driver):
+                return False
+            autoplay_clicks += 1
+            return True
+
         print(f"🖥️ 停留 {cfg.dwell_seconds}s: {room_url}")
-        end_t = time.time() + cfg.dwell_seconds
-        while time.time() < end_t:
-            douyu_mouse_click_autoplay_if_present(driver)
-            time.sleep(0.6)
+        abort_reason, playback = dwell_with_health_monitor(driver, cfg, on_overlay=click_overlay)
+
+        autoplay_overlays = douyu_autoplay_seen_count(driver)
+        print(f"▶️ autoplay遮罩出现 {autoplay_overlays} 次，鼠标点击 {autoplay_clicks} 次")
 
     finally:
+        # ✅ 停留结束立刻停抓包（关浏览器 / 等 profile 锁的流量不进 pcap）
+        capture.stop()
+
         # ✅ 先关浏览器（满足“进入下一房间前先关闭浏览器”）
-        if driver:
-            try:
-                driver.quit()
-            except Exception:
-                pass
+        if driver and pool is not None:
+            pool.release()
+        elif driver:
+            quit_driver(driver)
 
         # ✅ 等 profile 锁释放（避免下一轮启动被占用）
-        if user_data_dir:
+        if user_data_dir and pool is None:
             if not wait_profile_released(user_data_dir, timeout=12.0):
                 print("⚠️ profile 锁未及时释放，下一轮将重试/必要时清锁")
 
-        # 再结束 tshark
-        if tshark_proc:
-            try:
-                tshark_proc.wait(timeout=15)
-            except Exception:
-                tshark_proc.terminate()
-                try:
-                    tshark_proc.wait(timeout=5)
-                except Exception:
-                    pass
-
         safe_picked = re.sub(r"[\\/:*?\"<>|]", "_", (picked or "unknown")).replace(" ", "")
-        final_filename = f"{safe_cat}_{safe_picked}_{timestamp}.pcap"
+        final_filename = f"{safe_cat}_{safe_picked}_{timestamp}{worker_suffix}.pcap"
         final_filepath = os.path.join(cfg.pcap_dir, final_filename)
 
         try:
             if os.path.exists(final_filepath):
                 suffix = random.randint(1000, 9999)
-                final_filename = f"{safe_cat}_{safe_picked}_{timestamp}_{suffix}.pcap"
+                final_filename = f"{safe_cat}_{safe_picked}_{timestamp}{worker_suffix}_{suffix}.pcap"
                 final_filepath = os.path.join(cfg.pcap_dir, final_filename)
 
             os.rename(tmp_filepath, final_filepath)
+            saved_path = final_filepath
             print(f"🛑 抓包已保存: {final_filepath}\n")
         except Exception as e:
+            if os.path.exists(tmp_filepath):
+                saved_path = tmp_filepath
             print(f"⚠️ 改名失败，保留临时文件: {tmp_filepath}，原因: {e}\n")
 
+        if saved_path:
+            capture.write_sidecars(saved_path)
+            write_capture_meta(saved_path, {
+                "platform": PLATFORM,
+                "room_url": room_url,
+                "room_id": canonical_room_id(room_url),
+                "category": category_name,
+                "started_at": timestamp,
+                "preferred_qualities": list(cfg.preferred_qualities),
+                "quality": picked,
+                "quality_ladder": ladder,
+                "abort_reason": abort_reason,
+                "playback": playback,
+                "capture": capture.meta(),
+                "autoplay_clicks": autoplay_clicks,
+                "autoplay_overlays": autoplay_overlays,
+            })
+
+    selector_stats(cfg).flush()    # 选择器统计一个会话落一次盘
+    return {"room_url": room_url, "quality": picked, "ladder": ladder, "pcap_path": saved_path,
+            "abort_reason": abort_reason}
+
+
+# ----------------------------
+# 采集台账：SQLite 记录每个房间（平台 + 规范房间 id）的采集时间 / 画质 / 画质阶梯 / pcap 路径
+# ----------------------------
+def canonical_room_id(room_url: str) -> str:
+    """直播间 URL → 稳定的房间 id（台账的 key）；认不出来时用去掉 query 的 URL。"""
+    m = re.search(r"douyu\.com/(\d+)", room_url or "")
+    return m.group(1) if m else (room_url or "").split("?")[0].rstrip("/")
+
+
+class CaptureLedger:
+    """
+    多个 worker 线程共用一个连接（加锁）；WAL 模式下四个平台脚本也可以共用同一个库文件。
+    """
+
+    def __init__(self, path: str, platform: str = PLATFORM):
+        self.path = path
+        self.platform = platform
+        self._lock = threading.Lock()
+        d = os.path.dirname(os.path.abspath(path))
+        os.makedirs(d, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=10.0, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS captures (
+                    platform    TEXT NOT NULL,
+                    room_id     TEXT NOT NULL,
+                    room_url    TEXT NOT NULL,
+                    category    TEXT,
+                    quality     TEXT,
+                    pcap_path   TEXT,
+                    captured_at REAL NOT NULL,
+                    ladder      TEXT,
+                    abort_reason TEXT
+                )
+            """)
+            cols = {row[1] for row in self._conn.execute("PRAGMA table_info(captures)")}
+            for col in ("ladder", "abort_reason"):
+                if col not in cols:
+                    self._conn.execute(f"ALTER TABLE captures ADD COLUMN {col} TEXT")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_captures_room ON captures (platform, room_id, captured_at)"
+            )
+
+    def record(self, category_name: str, result: Optional[dict]) -> None:
+        """只记录真正落盘了 pcap 的采集。"""
+        if not result or not result.get("pcap_path"):
+            return
+        room_url = result["room_url"]
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO captures (platform, room_id, room_url, category, quality, pcap_path, captured_at, "
+                "ladder, abort_reason) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.platform, canonical_room_id(room_url), room_url, category_name,
+                 result.get("quality"), result["pcap_path"], time.time(),
+                 json.dumps(result.get("ladder") or [], ensure_ascii=False), result.get("abort_reason")),
+            )
+
+    def last_captured(self, room_urls: List[str]) -> Dict[str, float]:
+        """room_id -> 最近一次完整采集的时间（没采过 / 只有提前结束的记录不在结果里）。"""
+        ids = sorted({canonical_room_id(u) for u in room_urls})
+        if not ids:
+            return {}
+        marks = ",".join("?" * len(ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT room_id, MAX(captured_at) FROM captures "
+                f"WHERE platform = ? AND room_id IN ({marks}) AND (abort_reason IS NULL OR abort_reason = '') "
+                f"GROUP BY room_id",
+                (self.platform, *ids),
+            ).fetchall()
+        return {rid: ts for rid, ts in rows}
+
+    def schedule(self, rooms: List[str], window_hours: float, policy: str = "skip") -> List[str]:
+        """
+        policy="skip"：窗口内采过的房间去掉；
+        policy="deprioritize"：窗口内采过的排到最后（越久没采的越靠前）。
+        其余房间保持发现顺序。
+        """
+        last = self.last_captured(rooms)
+        cutoff = time.time() - window_hours * 3600
+        fresh, recent = [], []
+        for u in rooms:
+            ts = last.get(canonical_room_id(u))
+            (recent if ts is not None and ts >= cutoff else fresh).append(u)
+
+        if recent:
+            verb = "跳过" if policy == "skip" else "排到最后"
+            print(f"📒 台账：{len(recent)} 个房间 {window_hours:g}h 内采过，{verb}")
+        if policy == "skip":
+            return fresh
+        recent.sort(key=lambda u: last[canonical_room_id(u)])
+        return fresh + recent
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_CAPTURE_LEDGERS: Dict[str, CaptureLedger] = {}
+
+
+def open_capture_ledger(cfg: RunConfig) -> Optional[CaptureLedger]:
+    """ledger_path 为空时返回 None；同一路径在进程内只打开一次（main() 会被循环调用）。"""
+    if not cfg.ledger_path:
+        return None
+    ledger = _CAPTURE_LEDGERS.get(cfg.ledger_path)
+    if ledger is None:
+        ledger = CaptureLedger(cfg.ledger_path)
+        _CAPTURE_LEDGERS[cfg.ledger_path] = ledger
+    return ledger
+
+
+# ----------------------------
+# 并发采集：有界 worker 池（每个 worker 独立 Chrome / 独立 profile 副本 / 独立 pcap）
+# ----------------------------
+# 复制 profile 时跳过：锁文件 + 各类缓存（只要登录态，不要缓存）
+_PROFILE_CLONE_IGNORE = (
+    "SingletonLock", "SingletonCookie", "SingletonSocket", "lockfile",
+    "Cache", "Code Cache", "GPUCache", "ShaderCache", "GrShaderCache",
+    "Service Worker", "Crashpad", "BrowserMetrics*",
+)
+
+
+def clone_profile_for_worker(cfg: RunConfig, worker_id: int) -> Optional[str]:
+    """
+    把登录态 profile 复制一份给 worker 独占，避免多个 Chrome 抢同一个 user-data-dir。
+    只复制 Local State + 指定的 profile 目录；返回副本的 user-data-dir（失败返回 None）。
+    """
+    src = get_user_data_dir_from_arg(cfg.user_data_arg or "")
+    if not src or not os.path.isdir(src):
+        return None
+
+    root = cfg.profile_clone_root or tempfile.gettempdir()
+    dst = os.path.join(root, f"lvcap_profile_w{worker_id}_{os.getpid()}")
+    shutil.rmtree(dst, ignore_errors=True)
+    os.makedirs(dst, exist_ok=True)
+
+    local_state = os.path.join(src, "Local State")
+    if os.path.exists(local_state):
+        shutil.copy2(local_state, dst)
+
+    profile = cfg.profile_directory or "Default"
+    try:
+        shutil.copytree(
+            os.path.join(src, profile),
+            os.path.join(dst, profile),
+            ignore=shutil.ignore_patterns(*_PROFILE_CLONE_IGNORE),
+            ignore_dangling_symlinks=True,
+        )
+    except shutil.Error as e:
+        # 个别文件被占用（例如手动开着的 Chrome）时，其余文件照常可用
+        print(f"⚠️ [w{worker_id}] profile 部分文件复制失败（共 {len(e.args[0])} 个），继续使用副本")
+    except OSError as e:
+        print(f"⚠️ [w{worker_id}] profile 复制失败: {e}")
+        shutil.rmtree(dst, ignore_errors=True)
+        return None
+    return dst
+
+
+def _capture_worker(worker_id: int, cfg: RunConfig, category_name: str,
+                    room_queue: "queue.Queue[Tuple[int, str]]", total: int, stats: Dict[int, Dict[str, float]],
+                    ledger: Optional[CaptureLedger] = None):
+    st = stats[worker_id]
+    st["started"] = time.time()
+
+    # 热浏览器：worker 内所有房间共用一个 Chrome
+    pool = WarmDriverPool(cfg) if cfg.reuse_browser else None
+
+    try:
+        while True:
+            try:
+                idx, room_url = room_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            try:
+                print(f"\n===== [w{worker_id}] [{idx}/{total}] 开始采集: {room_url} =====")
+                result = run_capture_session_douyu_restart_browser(cfg, category_name, room_url, worker_id=worker_id, pool=pool)
+                if ledger is not None:
+                    ledger.record(category_name, result)
+                st["done"] += 1
+                if result and result.get("abort_reason"):
+                    st["aborted"] += 1
+            except Exception as e:
+                st["failed"] += 1
+                print(f"❌ [w{worker_id}] 直播间采集失败，跳过: {room_url}")
+                print(f"   异常类型: {type(e).__name__}")
+                print(f"   异常信息: {e}")
+                traceback.print_exc()
+                time.sleep(2)
+
+            hours = max(time.time() - st["started"], 1e-6) / 3600.0
+            print(f"📈 [w{worker_id}] 已完成 {int(st['done'])} 间（失败 {int(st['failed'])}），"
+                  f"速率 {st['done'] / hours:.1f} rooms/hour")
+    finally:
+        if pool is not None:
+            pool.close()
+        st["elapsed"] = time.time() - st["started"]
+
+
+def run_sessions_concurrently(cfg: RunConfig, category_name: str, rooms: List[str],
+                              ledger: Optional[CaptureLedger] = None) -> None:
+    """
+    ✅ 最多 cfg.max_concurrent_sessions 个直播间同时采集。
+    并发数为 1 时直接用原 profile（行为与逐个采集一致）；>1 时每个 worker 用自己的 profile 副本。
+    """
+    if not rooms:
+        print("没有需要采集的直播间，本轮结束。")
+        return
+
+    n = max(1, min(cfg.max_concurrent_sessions, len(rooms)))
+
+    room_queue: "queue.Queue[Tuple[int, str]]" = queue.Queue()
+    for idx, room_url in enumerate(rooms, 1):
+        room_queue.put((idx, room_url))
+
+    stats: Dict[int, Dict[str, float]] = {}
+    clones: List[str] = []
+    threads: List[threading.Thread] = []
+    t0 = time.time()
+
+    slots = netns_pool(cfg).ensure(max(n, cfg.netns_pool_size)) if cfg.netns_isolation else []
+
+    try:
+        for w in range(1, n + 1):
+            wcfg = cfg
+            if slots:
+                slot = slots[w - 1]
+                wcfg = replace(wcfg, netns_name=slot.name, network_iface=slot.host_if,
+                               capture_filter=netns_capture_filter(cfg, slot))
+            if n > 1 and not cfg.login_vault_path and cfg.user_data_arg:
+                clone = clone_profile_for_worker(cfg, w)
+                if not clone:
+                    # 退回原 profile 会让几个 Chrome 抢同一把 profile 锁，宁可少一个 worker
+                    print(f"⚠️ [w{w}] profile 副本没建成，这个 worker 不启动")
+                    continue
+                clones.append(clone)
+                wcfg = replace(wcfg, user_data_arg=f"--user-data-dir={clone}")
+
+            stats[w] = {"done": 0, "failed": 0, "aborted": 0, "started": time.time(), "elapsed": 0.0}
+            t = threading.Thread(
+                target=_capture_worker,
+                args=(w, wcfg, category_name, room_queue, len(rooms), stats, ledger),
+                name=f"capture-w{w}",
+                daemon=True,
+            )
+            threads.append(t)
+            t.start()
+
+        if not threads:
+            print("❌ 没有一个 worker 能拿到自己的 profile 副本，本轮并发采集取消")
+            return
+        for t in threads:
+            t.join()
+    finally:
+        for clone in clones:
+            shutil.rmtree(clone, ignore_errors=True)
+
+    total_done = sum(int(st["done"]) for st in stats.values())
+    wall_hours = max(time.time() - t0, 1e-6) / 3600.0
+    print(f"\n📊 并发采集结束：{len(threads)} 个 worker，共完成 {total_done}/{len(rooms)} 间")
+    for w, st in sorted(stats.items()):
+        hours = max(st["elapsed"], 1e-6) / 3600.0
+        print(f"   w{w}: 完成 {int(st['done'])}（提前结束 {int(st['aborted'])}），失败 {int(st['failed'])}，"
+              f"{st['done'] / hours:.1f} rooms/hour")
+    print(f"   合计: {total_done / wall_hours:.1f} rooms/hour")
+
+
+# ----------------------------
+# 发现缓存：分类 / 房间列表跨 main() 迭代复用（每个 key 自己的 TTL + 条数上限 LRU 淘汰，落盘 JSON）
+# ----------------------------
+class DiscoveryCache:
+    """
+    get_or_refresh(key, ttl, loader)：
+      - 新鲜 → 直接返回缓存
+      - 过期 → background=True 时先返回旧值、后台线程刷新；否则同步重新加载
+      - 没有 → 同步加载
+    空结果不缓存（多半是页面/接口出错）。
+    """
+
+    def __init__(self, path: str, max_entries: int = 64):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.RLock()
+        self._refreshing: Set[str] = set()
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for k, e in (json.load(f) or {}).items():
+                    self._entries[k] = e
+        except (OSError, ValueError):
+            pass
+
+    def _save(self) -> None:
+        d = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(d, exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def get(self, key: str):
+        """返回 (value, age_seconds, fresh)；没有时 value 为 None。"""
+        with self._lock:
+            e = self._entries.get(key)
+            if e is None:
+                return None, 0.0, False
+            self._entries.move_to_end(key)
+            age = time.time() - e["stored_at"]
+            return e["value"], age, age < e["ttl"]
+
+    def put(self, key: str, value, ttl: float) -> None:
+        if not value:
+            return
+        with self._lock:
+            self._entries[key] = {"value": value, "stored_at": time.time(), "ttl": ttl}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def _refresh_in_background(self, key: str, ttl: float, loader) -> None:
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self.put(key, loader(), ttl)
+                print(f"♻️ 后台刷新完成: {key}")
+            except Exception as e:
+                print(f"⚠️ 后台刷新失败: {key}，原因: {type(e).__name__}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name="discovery-refresh", daemon=True).start()
+
+    def get_or_refresh(self, key: str, ttl: float, loader, background: bool = True):
+        value, age, fresh = self.get(key)
+        if value is not None and fresh:
+            print(f"♻️ 使用缓存: {key}（{age:.0f}s 前）")
+            return value
+        if value is not None and background:
+            print(f"♻️ 使用过期缓存: {key}（{age:.0f}s 前），后台刷新")
+            self._refresh_in_background(key, ttl, loader)
+            return value
+
+        value = loader()
+        self.put(key, value, ttl)
+        return value
+
+
+_DISCOVERY_CACHES: Dict[str, DiscoveryCache] = {}
+
+
+def cached_discovery(cfg: RunConfig, key: str, ttl: float, loader):
+    """
+    discovery_cache_path 为空时直接加载。
+    只有 HTTP 发现才允许后台刷新：后台开浏览器会和正在采集的会话抢 profile，也会把流量混进 pcap。
+    """
+    if not cfg.discovery_cache_path:
+        return loader()
+    cache = _DISCOVERY_CACHES.get(cfg.discovery_cache_path)
+    if cache is None:
+        cache = DiscoveryCache(cfg.discovery_cache_path, cfg.discovery_cache_max_entries)
+        _DISCOVERY_CACHES[cfg.discovery_cache_path] = cache
+    return cache.get_or_refresh(key, ttl, loader, background=(cfg.discovery_backend == "http"))
+
+
+def with_list_driver(cfg: RunConfig, fn, *args, **kwargs):
+    """临时启动一个浏览器做列表抓取，用完立刻关掉并等 profile 释放。"""
+    driver = build_driver_with_retry(cfg)
+    try:
+        return fn(driver, *args, **kwargs)
+    finally:
+        quit_driver(driver)
+        user_data_dir = shared_profile_dir(cfg)
+        if user_data_dir:
+            wait_profile_released(user_data_dir, timeout=12.0)
+
+
+def load_rooms(cfg: RunConfig, category_url: str, limit: int) -> List[str]:
+    rooms = get_live_rooms_http(cfg, category_url, limit=limit)
+    if rooms is not None:
+        return rooms
+    return with_list_driver(cfg, get_live_rooms_in_category_douyu, category_url, limit=limit)
+
 
 # ----------------------------
 # 主流程（先抓 rooms，再逐个房间重启浏览器采集）
@@ -589,6 +3906,15 @@ def main():
         preferred_qualities=("原画", "蓝光", "超清", "高清"),
         headless=False,
 
+        # ✅ 同时采集的直播间数（>1 时每个 worker 使用独立 profile 副本）
+        max_concurrent_sessions=1,
+
+        # 可选：登录态保险箱（设置后每个浏览器用临时 profile + 注入登录态）
+        # login_vault_path="login_vault.json",
+
+        # 可选：采集台账（最近 ledger_window_hours 小时采过的房间跳过）
+        # ledger_path="captures/ledger.sqlite3",
+
         # ✅ 必须复用登录态（注意要带 --）
         user_data_arg=r"--user-data-dir=C:\Users\***\AppData\Local\Google\Chrome for Testing\User Data",
 
@@ -596,84 +3922,81 @@ def main():
         profile_directory="Default",
     )
 
-    user_data_dir = get_user_data_dir_from_arg(cfg.user_data_arg or "")
-
-    # 1) 用 list_driver 抓分类/房间列表（抓完就关）
-    list_driver = build_driver_with_retry(cfg)
-    try:
-        # categories = get_categories_douyu_simple(list_driver)
-        #
-        # if categories:
-        #     print("检测到分类（可能不全）：")
-        #     items = list(categories.items())
-        #     for i, (u, name) in enumerate(items, 1):
-        #         print(f"{i}. {name}  |  {u}")
-        #
-        #     print("\n输入序号选择分类；或直接粘贴分类URL：")
-        #     choice = input().strip()
-        #
-        #     if choice.isdigit() and 1 <= int(choice) <= len(items):
-        #         category_url, category_name = items[int(choice) - 1]
-        #     else:
-        #         category_url = choice
-        #         category_name = "manual"
-        # else:
-        print("未能自动识别分类链接（正常现象，斗鱼结构常变）。请直接粘贴分类URL：")
-        print("- 热门游戏: https://www.douyu.com/g_rmyx")
-        print("- 户外: https://www.douyu.com/g_HW")
-        print("- 星秀: https://www.douyu.com/g_xingxiu")
-        print("- 二次元: https://www.douyu.com/g_ecy")
-        print("- 聊天: https://www.douyu.com/g_xdpd")
-        print("- 派对: https://www.douyu.com/g_paidui")
-        print("- 单机游戏: https://www.douyu.com/g_OG")
-        print("请直接粘贴分类URL：")
-
-        category_url = input().strip()
-
-        if "g_xdpd" in category_url:
-            category_name = "聊天"
-        elif "g_paidui" in category_url:
-            category_name = "派对"
-        elif "g_xingxiu" in category_url:
-            category_name = "星秀"
-        elif "g_rmyx" in category_url:
-            category_name = "热门游戏"
-        elif "g_OG" in category_url:
-            category_name = "单机游戏"
-        else:
-            category_name = "manual"
+    # 保险箱模式：先确保登录态已导出（此时还没有任何浏览器占用登录 profile）
+    ensure_login_vault(cfg)
+
+    # 1) 抓分类/房间列表：优先用发现缓存（discovery_cache_path）；
+    #    需要浏览器的加载函数自己临时开/关浏览器，列表抓完 profile 即释放
+    # categories = get_categories_douyu_simple(list_driver)
+    #
+    # if categories:
+    #     print("检测到分类（可能不全）：")
+    #     items = list(categories.items())
+    #     for i, (u, name) in enumerate(items, 1):
+    #         print(f"{i}. {name}  |  {u}")
+    #
+    #     print("\n输入序号选择分类；或直接粘贴分类URL：")
+    #     choice = input().strip()
+    #
+    #     if choice.isdigit() and 1 <= int(choice) <= len(items):
+    #         category_url, category_name = items[int(choice) - 1]
+    #     else:
+    #         category_url = choice
+    #         category_name = "manual"
+    # else:
+    print("未能自动识别分类链接（正常现象，斗鱼结构常变）。请直接粘贴分类URL：")
+    print("- 热门游戏: https://www.douyu.com/g_rmyx")
+    print("- 户外: https://www.douyu.com/g_HW")
+    print("- 星秀: https://www.douyu.com/g_xingxiu")
+    print("- 二次元: https://www.douyu.com/g_ecy")
+    print("- 聊天: https://www.douyu.com/g_xdpd")
+    print("- 派对: https://www.douyu.com/g_paidui")
+    print("- 单机游戏: https://www.douyu.com/g_OG")
+    print("请直接粘贴分类URL：")
+
+    category_url = input().strip()
+
+    if "g_xdpd" in category_url:
+        category_name = "聊天"
+    elif "g_paidui" in category_url:
+        category_name = "派对"
+    elif "g_xingxiu" in category_url:
+        category_name = "星秀"
+    elif "g_rmyx" in category_url:
+        category_name = "热门游戏"
+    elif "g_OG" in category_url:
+        category_name = "单机游戏"
+    else:
+        category_name = "manual"
+
+    print(f"已设置分类: {category_name}")
+
+    # 开了台账时多发现几倍：窗口内采过的房间会被跳过，要有后备房间补足 rooms_per_category
+    fetch_n = cfg.rooms_per_category * (max(1, cfg.ledger_overfetch) if cfg.ledger_path else 1)
+    rooms = cached_discovery(
+        cfg, f"rooms|{category_url}|{fetch_n}", cfg.rooms_cache_ttl,
+        lambda: load_rooms(cfg, category_url, fetch_n),
+    )
+    print(f"\n分类 [{category_name}] 抓到直播间数量: {len(rooms)}")
+    for r in rooms:
+        print(" -", r)
 
-        print(f"已设置分类: {category_name}")
+    # 2) 采集台账：窗口内采过的房间跳过（或排到最后）
+    ledger = open_capture_ledger(cfg)
+    if ledger is not None:
+        rooms = ledger.schedule(rooms, cfg.ledger_window_hours, cfg.ledger_policy)
 
-        rooms = get_live_rooms_in_category_douyu(list_driver, category_url, limit=cfg.rooms_per_category)
-        print(f"\n分类 [{category_name}] 抓到直播间数量: {len(rooms)}")
-        for r in rooms:
-            print(" -", r)
-
-    finally:
-        try:
-            list_driver.quit()
-        except Exception:
-            pass
-        if user_data_dir:
-            wait_profile_released(user_data_dir, timeout=12.0)
+    # 3) 开播预检：下播 / 轮播的房间不进入采集；然后截到本轮要采的数量
+    rooms = filter_live_rooms(cfg, rooms)[:cfg.rooms_per_category]
 
     if not rooms:
-        print("没有抓到房间，退出。")
+        # 都采过 / 都下播了：等一会再重新发现，别让外层循环每秒空转打接口
+        print(f"没有可采的房间，{cfg.idle_backoff_seconds:g}s 后再试。")
+        time.sleep(cfg.idle_backoff_seconds)
         return
 
-    # 2) ✅ 逐个房间：每次都“先关闭浏览器（上一轮已 quit）→ 再启动新浏览器 → 输入 room_url”
-    for idx, room_url in enumerate(rooms, 1):
-        try:
-            print(f"\n===== [{idx}/{len(rooms)}] 开始采集: {room_url} =====")
-            run_capture_session_douyu_restart_browser(cfg, category_name, room_url)
-        except Exception as e:
-            print(f"❌ 直播间采集失败，跳过: {room_url}")
-            print(f"   异常类型: {type(e).__name__}")
-            print(f"   异常信息: {e}")
-            traceback.print_exc()
-            time.sleep(2)
-            continue
+    # ✅ 逐个直播间（max_concurrent_sessions > 1 时并发）：每个 worker 都“先没有浏览器 → 再启动浏览器 → 输入URL”
+    run_sessions_concurrently(cfg, category_name, rooms, ledger=ledger)
 
 
 # 入口：无限循环运行（你原来的行为）
@@ -0,0 +1,44 @@
+"""run_sessions_concurrently：每个 worker 的配置（netns 槽位 + profile 副本）要同时生效。"""
+import pytest
+
+from conftest import SCRIPTS, load_script
+
+
+class FakeSlot:
+    def __init__(self, i):
+        self.name = f"lvcap{i}"
+        self.host_if = f"lvcaph{i}"
+        self.ns_ip = f"10.231.0.{4 * i + 2}"
+
+
+class FakePool:
+    def ensure(self, n):
+        return [FakeSlot(i) for i in range(n)]
+
+
+@pytest.mark.parametrize("script", list(SCRIPTS))
+def test_netns_slots_survive_profile_clones(script, monkeypatch, tmp_path):
+    mod = load_script(script)
+    seen = {}
+    monkeypatch.setattr(mod, "netns_pool", lambda cfg: FakePool())
+    monkeypatch.setattr(mod, "clone_profile_for_worker", lambda cfg, w: str(tmp_path / f"clone{w}"))
+    monkeypatch.setattr(mod, "_capture_worker", lambda w, wcfg, *a: seen.__setitem__(w, wcfg))
+
+    cfg = mod.RunConfig(max_concurrent_sessions=2, netns_isolation=True, network_iface="eth0",
+                        user_data_arg=f"--user-data-dir={tmp_path / 'profile'}")
+    mod.run_sessions_concurrently(cfg, "cat", ["room-a", "room-b"])
+
+    assert sorted(seen) == [1, 2]
+    for w, wcfg in seen.items():
+        assert wcfg.netns_name == f"lvcap{w - 1}"
+        assert wcfg.network_iface == f"lvcaph{w - 1}"
+        assert wcfg.user_data_arg == f"--user-data-dir={tmp_path / f'clone{w}'}"
+        # 宿主 ↔ netns 里 chromedriver 的 WebDriver 流量不进这个 worker 的 pcap
+        assert wcfg.capture_filter == f"not (host 10.231.0.{4 * (w - 1) + 2} and tcp port {cfg.netns_driver_port})"
+
+
+@pytest.mark.parametrize("script", list(SCRIPTS))
+def test_netns_capture_filter_keeps_user_filter(script):
+    mod = load_script(script)
+    cfg = mod.RunConfig(capture_filter="tcp or udp", netns_driver_port=9600)
+    assert mod.netns_capture_filter(cfg, FakeSlot(1)) == "(tcp or udp) and not (host 10.231.0.6 and tcp port 9600)"
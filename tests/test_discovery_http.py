@@ -0,0 +1,45 @@
+"""HTTP 房间发现：本地替身服务器回放录制的列表接口响应，经 cfg.discovery_api_base 走完整的 get_live_rooms_http。"""
+import pytest
+
+from conftest import load_fixture, load_script
+
+PLATFORMS = ["bilibili", "douyin", "douyu", "huya"]
+
+
+@pytest.mark.parametrize("platform", PLATFORMS)
+def test_recorded_pages_normalize_to_room_urls(platform, recorded_server):
+    mod = load_script(platform)
+    fx = load_fixture(f"discovery_{platform}.json")
+    server = recorded_server(fx["exchanges"])
+    cfg = mod.RunConfig(discovery_backend="http", discovery_api_base=server.base)
+
+    rooms = mod.get_live_rooms_http(cfg, fx["category_url"], limit=50)
+
+    # 跨页去重、丢掉无效条目，顺序和接口一致；翻到最后一页就停
+    assert rooms == fx["expected"]
+    assert len(server.requests) == len(fx["exchanges"])
+
+
+@pytest.mark.parametrize("platform", PLATFORMS)
+def test_limit_stops_paging(platform, recorded_server):
+    mod = load_script(platform)
+    fx = load_fixture(f"discovery_{platform}.json")
+    server = recorded_server(fx["exchanges"])
+    cfg = mod.RunConfig(discovery_backend="http", discovery_api_base=server.base)
+
+    rooms = mod.get_live_rooms_http(cfg, fx["category_url"], limit=2)
+
+    # 前两间都在第一页：拿够就返回，不再请求第二页
+    assert rooms == fx["expected"][:2]
+    assert len(server.requests) == 1
+
+
+@pytest.mark.parametrize("platform", PLATFORMS)
+def test_api_error_falls_back(platform, recorded_server):
+    mod = load_script(platform)
+    fx = load_fixture(f"discovery_{platform}.json")
+    server = recorded_server([])    # 什么都不回放：404
+    cfg = mod.RunConfig(discovery_backend="http", discovery_api_base=server.base)
+
+    # None = 调用方回退 Selenium
+    assert mod.get_live_rooms_http(cfg, fx["category_url"], limit=5) is None
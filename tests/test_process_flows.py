@@ -0,0 +1,49 @@
+"""ProcessFlowTracker：没 connect 的 UDP 只按本机这一端认，对端由发出去的第一个包钉住。"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import SCRIPTS, load_script
+
+pytestmark = pytest.mark.skipif(not os.path.isdir("/proc/self/net"), reason="需要 Linux /proc")
+
+CHILD = """
+import socket, sys
+u = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+u.bind(("127.0.0.1", 0))
+print(u.getsockname()[1], flush=True)
+sys.stdin.read()
+"""
+
+
+@pytest.fixture
+def udp_child():
+    proc = subprocess.Popen([sys.executable, "-c", CHILD], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        yield proc.pid, int(proc.stdout.readline())
+    finally:
+        proc.stdin.close()
+        proc.wait(timeout=5)
+
+
+@pytest.mark.parametrize("script", list(SCRIPTS))
+def test_unconnected_udp_matches_local_end_and_pinned_peer(script, udp_child):
+    mod = load_script(script)
+    pid, port = udp_child
+    tracker = mod.ProcessFlowTracker(pid)
+    tracker.refresh()
+    assert tracker.unconnected == {("udp", port): {"127.0.0.1"}}
+
+    # 别的主机恰好用了同一个端口号：不是这个 socket 的
+    assert not tracker.owns(("udp", "10.0.0.5", port, "10.0.0.6", 9999))
+    assert not tracker.owns(("udp", "10.0.0.6", 9999, "10.0.0.5", port))
+    # 本地地址对不上
+    assert not tracker.owns(("udp", "127.0.0.2", port, "127.0.0.9", 53))
+    # 对端还没钉住时，发进来的包不算
+    assert not tracker.owns(("udp", "127.0.0.9", 53, "127.0.0.1", port))
+
+    assert tracker.owns(("udp", "127.0.0.1", port, "127.0.0.9", 53))
+    assert tracker.owns(("udp", "127.0.0.9", 53, "127.0.0.1", port))
+    assert not tracker.owns(("udp", "127.0.0.8", 53, "127.0.0.1", port))